@@ -1,336 +1,1651 @@
 from datetime import timedelta
 
+import asyncio
+import bisect
 import json
+import functools
+import collections
+import copy
+import hashlib
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
+import signal
+import threading
+import time
+import urllib.parse
 from kubernetes import client, config, watch
 from azure.identity import ClientSecretCredential
+from azure.core.polling.base_polling import get_retry_after
+from azure.mgmt.core.polling.arm_polling import ARMPolling
+from azure.mgmt.core.polling.async_arm_polling import AsyncARMPolling
+from azure.identity.aio import ClientSecretCredential as AsyncClientSecretCredential
 from kubernetes.client.rest import ApiException
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 from azure.mgmt.kusto.models import ReadWriteDatabase
 from azure.mgmt.kusto import KustoManagementClient
+from azure.mgmt.kusto.aio import KustoManagementClient as AsyncKustoManagementClient
 from azure.mgmt.kusto.models import DatabasePrincipalAssignment
 from azure.mgmt.kusto.models import EventHubDataConnection
 from azure.kusto.data import KustoClient, KustoConnectionStringBuilder
-from azure.mgmt.authorization import AuthorizationManagementClient
+from azure.mgmt.authorization.aio import AuthorizationManagementClient as AsyncAuthorizationManagementClient
 from azure.mgmt.authorization.models import RoleAssignmentCreateParameters
 
 
-def get_azure_token(scope: str = "default") -> str:
-    """Returns an azure token"""
-    credentials = ClientSecretCredential(
+@functools.lru_cache(maxsize=None)
+def get_credential() -> ClientSecretCredential:
+    """Returns the azure credential shared by the whole process"""
+    return ClientSecretCredential(
         client_id=os.environ.get("CLIENT_ID"),
         tenant_id=os.environ.get("TENANT_ID"),
         client_secret=os.environ.get("CLIENT_SECRET"),
     )
+
+
+def get_azure_token(scope: str = "default") -> str:
+    """Returns an azure token"""
     scope = os.environ.get("API_SCOPE")
     try:
-        token = credentials.get_token(scope)
+        token = get_credential().get_token(scope)
         return token.token
     except Exception:
         pass
 
 
-def delete_obj(database_name: str):
-    kusto_client = KustoManagementClient(
-        credential=ClientSecretCredential(
+@functools.lru_cache(maxsize=None)
+def get_kusto_client() -> KustoManagementClient:
+    return KustoManagementClient(
+        credential=get_credential(),
+        subscription_id=os.environ.get("AZURE_SUBSCRIPTION"),
+    )
+
+
+class AsyncAzure:
+    """Async credential and management clients shared by every reconcile, bound to one event loop thread"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        # the blocking Kusto calls of the steps of every reconcile run on the loop's default executor
+        self.loop.set_default_executor(
+            ThreadPoolExecutor(
+                max_workers=int(os.environ.get("WORKERS", "4")) * int(os.environ.get("ADX_CONCURRENCY", "8"))
+            )
+        )
+        subscription = os.environ.get("AZURE_SUBSCRIPTION")
+        self.credential = AsyncClientSecretCredential(
             client_id=os.environ.get("CLIENT_ID"),
             tenant_id=os.environ.get("TENANT_ID"),
             client_secret=os.environ.get("CLIENT_SECRET"),
-        ),
-        subscription_id=os.environ.get("AZURE_SUBSCRIPTION"),
+        )
+        self.kusto_client = AsyncKustoManagementClient(credential=self.credential, subscription_id=subscription)
+        self.iam_client = AsyncAuthorizationManagementClient(credential=self.credential, subscription_id=subscription)
+        # started last, a failed build leaves no loop thread behind
+        threading.Thread(target=self.loop.run_forever, name="azure-aio", daemon=True).start()
+
+    def run(self, coroutine):
+        """Runs the coroutine on the shared loop from any thread and waits for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def _close(self):
+        await self.kusto_client.close()
+        await self.iam_client.close()
+        await self.credential.close()
+
+    def close(self):
+        try:
+            asyncio.run_coroutine_threadsafe(self._close(), self.loop).result(timeout=10)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+ASYNC_AZURE = None
+ASYNC_AZURE_LOCK = threading.Lock()
+
+
+def get_async_azure() -> AsyncAzure:
+    """The AsyncAzure of the process, built once even when the workers first ask for it together"""
+    global ASYNC_AZURE
+    if ASYNC_AZURE is None:
+        with ASYNC_AZURE_LOCK:
+            if ASYNC_AZURE is None:
+                ASYNC_AZURE = AsyncAzure()
+    return ASYNC_AZURE
+
+
+LRO_SECONDS = Histogram(
+    "triskell_lro_seconds", "Polling time of Azure long running operations", ["operation"]
+)
+LRO_POLLS = Counter(
+    "triskell_lro_polls_total", "Status requests of Azure long running operations", ["operation"]
+)
+
+
+class PollScheduler:
+    """Paces the status requests of every long running operation of the process
+
+    The delay before a poll starts at LRO_POLL_INITIAL seconds and grows by LRO_POLL_FACTOR up to
+    LRO_POLL_MAX, never shorter than Retry-After, and polls are spread to at most ARM_POLL_RATE per second.
+    """
+
+    def __init__(self, rate: float, initial: float, factor: float, maximum: float):
+        self.interval = 1 / rate
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        # due times of the polls already scheduled, sorted
+        self._slots = []
+        self._lock = threading.Lock()
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+        """Seconds to wait before the poll number attempt, counted from 0
+
+        The poll takes the first free slot from its own due time, the backoff of the other operations
+        only matters when their polls fall within ARM_POLL_RATE of it.
+        """
+        delay = max(min(self.initial * self.factor**attempt, self.maximum), retry_after or 0)
+        with self._lock:
+            now = time.monotonic()
+            del self._slots[:bisect.bisect_right(self._slots, now - self.interval)]
+            slot = now + delay
+            for reserved in self._slots[bisect.bisect_right(self._slots, slot - self.interval):]:
+                if reserved >= slot + self.interval:
+                    break
+                slot = reserved + self.interval
+            bisect.insort(self._slots, slot)
+            return slot - now
+
+
+@functools.lru_cache(maxsize=None)
+def get_poll_scheduler() -> PollScheduler:
+    return PollScheduler(
+        rate=float(os.environ.get("ARM_POLL_RATE", "20")),
+        initial=float(os.environ.get("LRO_POLL_INITIAL", "0.5")),
+        factor=float(os.environ.get("LRO_POLL_FACTOR", "2")),
+        maximum=float(os.environ.get("LRO_POLL_MAX", "30")),
     )
+
+
+def operation_type(request) -> str:
+    """Method and resource type of the request starting an operation, e.g. PUT Microsoft.Kusto/clusters/databases"""
+    path = urllib.parse.urlparse(request.url).path.split("/providers/")[-1].split("/")
+    return f"{request.method} {'/'.join(path[:1] + path[1::2])}"
+
+
+class AdaptiveARMPolling(ARMPolling):
+    """ARM polling paced by the shared PollScheduler, one instance per operation"""
+
+    def next_delay(self) -> float:
+        self._attempt = getattr(self, "_attempt", -1) + 1
+        LRO_POLLS.labels(self.operation).inc()
+        return get_poll_scheduler().delay(self._attempt, get_retry_after(self._pipeline_response))
+
+    @property
+    def operation(self) -> str:
+        return operation_type(self._initial_response.http_response.request)
+
+    def _delay(self):
+        self._sleep(self.next_delay())
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            super().run()
+        finally:
+            LRO_SECONDS.labels(self.operation).observe(time.monotonic() - start)
+
+
+class AsyncAdaptiveARMPolling(AsyncARMPolling):
+    """Async ARM polling paced by the shared PollScheduler, one instance per operation"""
+
+    next_delay = AdaptiveARMPolling.next_delay
+    operation = AdaptiveARMPolling.operation
+
+    async def _delay(self):
+        await self._sleep(self.next_delay())
+
+    async def run(self):
+        start = time.monotonic()
+        try:
+            await super().run()
+        finally:
+            LRO_SECONDS.labels(self.operation).observe(time.monotonic() - start)
+
+
+def delete_obj(custom_resource: dict, continuation_token: str = None):
+    """Starts deleting the database of spec.id from the cluster recorded in the status, returns the poller"""
+    kusto_client = get_kusto_client()
     resource_group_name = os.environ.get("RESOURCE_GROUP_NAME")
-    adx_cluster_name = os.environ.get("ADX_CLUSTER_NAME")
-    kusto_client.databases.begin_delete(
+    adx_cluster_name = (custom_resource.get("status") or {}).get("cluster") or os.environ.get("ADX_CLUSTER_NAME")
+    return kusto_client.databases.begin_delete(
+        polling=AdaptiveARMPolling(),
         resource_group_name=resource_group_name,
         cluster_name=adx_cluster_name,
-        database_name=database_name,
-    ).result()
+        database_name=custom_resource["spec"]["id"],
+        continuation_token=continuation_token,
+    )
+
+
+CACHE_LOOKUPS = Counter(
+    "triskell_cr_cache_lookups_total",
+    "Custom resource lookups served by the informer cache",
+    ["plural", "result"],
+)
+
+
+class CRInformer:
+    """In-memory copy of api.cosmotech.com custom resources, fed by list+watch and indexed by name"""
+
+    def __init__(self, plural: str):
+        self.plural = plural
+        self.hits = 0
+        self.misses = 0
+        self._items = {}
+        self._lock = threading.Lock()
+        self._synced = threading.Event()
+        threading.Thread(target=self._run, name=f"informer-{plural}", daemon=True).start()
+
+    def _relist(self, api_instance, namespace: str) -> str:
+        response = api_instance.list_namespaced_custom_object(
+            "api.cosmotech.com", "v1", namespace, self.plural
+        )
+        with self._lock:
+            self._items = {
+                item["metadata"]["name"]: item for item in response.get("items", [])
+            }
+        self._synced.set()
+        return response["metadata"]["resourceVersion"]
+
+    def _run(self):
+        api_instance = client.CustomObjectsApi()
+        namespace = os.environ.get("NAMESPACE")
+        resource_version = ""
+        while True:
+            try:
+                if not resource_version:
+                    resource_version = self._relist(api_instance, namespace)
+                stream = watch.Watch().stream(
+                    api_instance.list_namespaced_custom_object,
+                    "api.cosmotech.com",
+                    "v1",
+                    namespace,
+                    self.plural,
+                    resource_version=resource_version,
+                )
+                for event in stream:
+                    if not event:
+                        continue
+                    obj = event["object"]
+                    with self._lock:
+                        if event["type"] == "DELETED":
+                            self._items.pop(obj["metadata"]["name"], None)
+                        else:
+                            self._items[obj["metadata"]["name"]] = obj
+                    resource_version = obj["metadata"]["resourceVersion"]
+            except ApiException as e:
+                if e.status == 410:
+                    # resourceVersion too old, start again from a fresh list
+                    resource_version = ""
+                else:
+                    print("Exception in %s informer: %s\n" % (self.plural, e))
+                    time.sleep(1)
+            except Exception as e:
+                print("Exception in %s informer: %s\n" % (self.plural, e))
+                time.sleep(1)
+
+    def get(self, name: str):
+        self._synced.wait(timeout=10)
+        with self._lock:
+            obj = self._items.get(name)
+            if obj is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if obj is not None:
+            CACHE_LOOKUPS.labels(self.plural, "hit").inc()
+            return obj
+        CACHE_LOOKUPS.labels(self.plural, "miss").inc()
+        # not seen by the watch yet, ask the API server directly
+        try:
+            obj = client.CustomObjectsApi().get_namespaced_custom_object(
+                group="api.cosmotech.com",
+                namespace=os.environ.get("NAMESPACE"),
+                name=name,
+                plural=self.plural,
+                version="v1",
+            )
+        except Exception as e:
+            print("Exception: %s\n" % e)
+            return None
+        with self._lock:
+            return self._items.setdefault(name, obj)
+
+
+INFORMERS = {}
+INFORMERS_LOCK = threading.Lock()
+
+
+def get_informer(plural: str) -> CRInformer:
+    with INFORMERS_LOCK:
+        if plural not in INFORMERS:
+            INFORMERS[plural] = CRInformer(plural=plural)
+        return INFORMERS[plural]
 
 
 def get_org_id_by_name(organization_name: str):
-    api_instance = client.CustomObjectsApi()
-    group = "api.cosmotech.com"  # Update to the correct API group
-    version = "v1"  # Update to the correct API version
-    namespace = os.environ.get("NAMESPACE")  # Assuming custom resource is in default namespace
-    plural = "organizations"
-    try:
-        api_response = api_instance.get_namespaced_custom_object(
-            group=group,
-            namespace=namespace,
-            name=organization_name,
-            plural=plural,
-            version=version,
-        )
-        print(api_response)
+    api_response = get_informer("organizations").get(organization_name)
+    if api_response:
         return api_response.get("spec").get("id")
-    except Exception as e:
-        print("Exception: %s\n" % e)
 
 
 def get_work_key_by_name(workspace_name: str):
-    api_instance = client.CustomObjectsApi()
-    group = "api.cosmotech.com"  # Update to the correct API group
-    version = "v1"  # Update to the correct API version
-    namespace = os.environ.get("NAMESPACE")  # Assuming custom resource is in default namespace
-    plural = "workspaces"
-    try:
-        api_response = api_instance.get_namespaced_custom_object(
-            group=group,
-            namespace=namespace,
-            name=workspace_name,
-            plural=plural,
-            version=version,
-        )
+    api_response = get_informer("workspaces").get(workspace_name)
+    if api_response:
         return api_response.get("spec").get("key")
-    except Exception as e:
-        print("Exception: %s\n" % e)
 
 
-def delete_permission(principal_id: str, database_name: str):
-    subscription = os.environ.get("AZURE_SUBSCRIPTION")
-    kusto_client = KustoManagementClient(
-        credential=ClientSecretCredential(
-            client_id=os.environ.get("CLIENT_ID"),
-            tenant_id=os.environ.get("TENANT_ID"),
-            client_secret=os.environ.get("CLIENT_SECRET"),
-        ),
-        subscription_id=subscription,
+KUSTO_POOL_SIZE = Gauge(
+    "triskell_kusto_client_pool_size", "Kusto data clients held in the pool"
+)
+KUSTO_POOL_EVICTIONS = Counter(
+    "triskell_kusto_client_pool_evictions_total", "Kusto data clients evicted from the pool"
+)
+
+
+class KustoClientPool:
+    """Bounded LRU pool of Kusto data clients keyed by cluster URI, sharing auth and HTTP connections"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._clients = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uri: str) -> KustoClient:
+        with self._lock:
+            if uri in self._clients:
+                self._clients.move_to_end(uri)
+                return self._clients[uri]
+            kbsc = KustoConnectionStringBuilder.with_aad_application_key_authentication(
+                aad_app_id=os.environ.get("CLIENT_ID"),
+                app_key=os.environ.get("CLIENT_SECRET"),
+                authority_id=os.environ.get("TENANT_ID"),
+                connection_string=uri,
+            )
+            kusto_client = KustoClient(kcsb=kbsc)
+            self._clients[uri] = kusto_client
+            while len(self._clients) > self.size:
+                _, evicted = self._clients.popitem(last=False)
+                evicted.close()
+                KUSTO_POOL_EVICTIONS.inc()
+            KUSTO_POOL_SIZE.set(len(self._clients))
+            return kusto_client
+
+
+@functools.lru_cache(maxsize=None)
+def get_kusto_pool() -> KustoClientPool:
+    return KustoClientPool(size=int(os.environ.get("KUSTO_POOL_SIZE", "8")))
+
+
+CLUSTER_INGESTION_UTILIZATION = Gauge(
+    "triskell_adx_cluster_ingestion_utilization",
+    "Share of the ingestion capacity in use on the ADX clusters, as last probed",
+    ["cluster"],
+)
+CLUSTER_DATABASES = Gauge(
+    "triskell_adx_cluster_databases", "Databases on the ADX clusters, as last probed", ["cluster"]
+)
+
+
+class AdxCluster:
+    """A cluster of ADX_CLUSTERS, its URI and identity are looked up in ARM unless given"""
+
+    def __init__(self, name: str, uri: str = ""):
+        self.name = name
+        self._uri = uri
+
+    @functools.cached_property
+    def resource(self):
+        return get_kusto_client().clusters.get(os.environ.get("RESOURCE_GROUP_NAME"), self.name)
+
+    @property
+    def uri(self) -> str:
+        return self._uri or self.resource.uri
+
+    @property
+    def principal_id(self) -> str:
+        if self.name == os.environ.get("ADX_CLUSTER_NAME") and os.environ.get("ADX_CLUSTER_PRINCIPAL_ID"):
+            return os.environ.get("ADX_CLUSTER_PRINCIPAL_ID")
+        return self.resource.identity.principal_id
+
+
+def probe_cluster(cluster: AdxCluster) -> dict:
+    """Capacity signals of a cluster: ingestion utilization and database count"""
+    kusto_client = get_kusto_pool().get(cluster.uri)
+    response = kusto_client.execute_mgmt("NetDefaultDB", ".show capacity")
+    ingestion = 0.0
+    for row in response.primary_results[0]:
+        if row["Resource"] == "Ingestions" and row["Total"]:
+            ingestion = row["Consumed"] / row["Total"]
+    response = kusto_client.execute_mgmt("NetDefaultDB", ".show databases")
+    return {"ingestion": ingestion, "databases": len(response.primary_results[0])}
+
+
+class ClusterPlacer:
+    """Picks the cluster of new databases from cached capacity signals of the configured clusters
+
+    The probe is a function of an AdxCluster returning {"ingestion": float, "databases": int}.
+    """
+
+    def __init__(self, clusters: list, probe=probe_cluster, ttl: float = 300):
+        self.clusters = {cluster.name: cluster for cluster in clusters}
+        self.probe = probe
+        self.ttl = ttl
+        self._signals = {}
+        self._lock = threading.Lock()
+
+    def cluster(self, name: str) -> AdxCluster:
+        """Cluster of an existing database, also for clusters dropped from ADX_CLUSTERS since"""
+        return self.clusters.get(name) or AdxCluster(name)
+
+    def signals(self, cluster: AdxCluster) -> dict:
+        with self._lock:
+            cached = self._signals.get(cluster.name)
+            if cached and time.monotonic() - cached[0] < self.ttl:
+                return cached[1]
+        try:
+            signals = self.probe(cluster)
+        except Exception as e:
+            # not cached, the next placement tries the cluster again
+            print(f"[adx] cannot probe cluster {cluster.name}: {e}")
+            return {"ingestion": float("inf"), "databases": sys.maxsize}
+        CLUSTER_INGESTION_UTILIZATION.labels(cluster.name).set(signals["ingestion"])
+        CLUSTER_DATABASES.labels(cluster.name).set(signals["databases"])
+        with self._lock:
+            self._signals[cluster.name] = (time.monotonic(), signals)
+        return signals
+
+    def place(self, hint: str = "") -> AdxCluster:
+        """Least loaded cluster by ingestion utilization then database count, or the hinted one"""
+        if hint:
+            if hint not in self.clusters:
+                raise ValueError(f"ADX cluster {hint} is not in ADX_CLUSTERS")
+            return self.clusters[hint]
+        loads = {name: self.signals(cluster) for name, cluster in self.clusters.items()}
+        name = min(loads, key=lambda n: (loads[n]["ingestion"], loads[n]["databases"]))
+        with self._lock:
+            if name in self._signals:
+                # counted right away so that a burst of new databases spreads over the clusters
+                self._signals[name][1]["databases"] += 1
+        print(f"[adx] placing database on cluster {name}")
+        return self.clusters[name]
+
+
+@functools.lru_cache(maxsize=None)
+def get_placer() -> ClusterPlacer:
+    """Clusters from ADX_CLUSTERS, comma separated 'name' or 'name=uri' entries, by default ADX_CLUSTER_NAME"""
+    clusters = []
+    for entry in (os.environ.get("ADX_CLUSTERS") or os.environ.get("ADX_CLUSTER_NAME")).split(","):
+        name, _, uri = entry.strip().partition("=")
+        clusters.append(AdxCluster(name, uri))
+    return ClusterPlacer(clusters, ttl=float(os.environ.get("ADX_PLACEMENT_CACHE_SECONDS", "300")))
+
+
+def database_parameters(resource_data: dict) -> ReadWriteDatabase:
+    # cache period by default 31 days
+    return ReadWriteDatabase(
+        location=os.environ.get("LOCATION"),
+        soft_delete_period=timedelta(days=resource_data.get("retention", 365)),
+        hot_cache_period=timedelta(days=resource_data.get("hotCachePeriod", 31)),
     )
-    resource_group_name = os.environ.get("RESOURCE_GROUP_NAME")
-    adx_cluster_name = os.environ.get("ADX_CLUSTER_NAME")
-    assignments = kusto_client.database_principal_assignments.list(
-        resource_group_name, adx_cluster_name, database_name
+
+
+WARM_POOL_SIZE = Gauge(
+    "triskell_adx_warm_pool_size", "Spare ADX databases ready to be claimed", ["cluster"]
+)
+WARM_POOL_BACKLOG = Gauge(
+    "triskell_adx_warm_pool_refill_backlog", "Spare ADX databases still to be created", ["cluster"]
+)
+WARM_POOL_CLAIMS = Counter(
+    "triskell_adx_warm_pool_claims_total", "Databases asked from the warm pool", ["result"]
+)
+WARM_POOL_CLAIM_SECONDS = Histogram(
+    "triskell_adx_warm_pool_claim_seconds", "Time to claim a spare ADX database"
+)
+
+
+class WarmPool:
+    """Keeps spare databases with the default settings on every cluster, created ahead of the workspaces
+
+    A spare database is named after the prefix and has no pretty name; claiming it sets its pretty name,
+    so the pool is found again by .show databases after a restart.
+    """
+
+    def __init__(self, size: int, clusters: list, prefix: str):
+        self.size = size
+        self.prefix = prefix
+        self.clusters = clusters
+        self._spare = {}
+        self._cond = threading.Condition()
+        if size:
+            threading.Thread(target=self._refill, name="warm-pool", daemon=True).start()
+
+    def claim(self, cluster: AdxCluster, pretty_name: str) -> str:
+        """Name of a spare database of the cluster now holding pretty_name, empty when there is none"""
+        start = time.monotonic()
+        with self._cond:
+            spare = self._spare.get(cluster.name) or []
+            database_name = spare.pop(0) if spare else ""
+            WARM_POOL_SIZE.labels(cluster.name).set(len(spare))
+            self._cond.notify()
+        if not database_name:
+            WARM_POOL_CLAIMS.labels("miss").inc()
+            return ""
+        get_kusto_pool().get(cluster.uri).execute_mgmt(
+            database_name, f".alter database ['{database_name}'] prettyname '{pretty_name}'"
+        )
+        WARM_POOL_CLAIMS.labels("hit").inc()
+        WARM_POOL_CLAIM_SECONDS.observe(time.monotonic() - start)
+        print(f"[adx] claimed spare database {database_name} on {cluster.name} for {pretty_name}")
+        return database_name
+
+    def _load(self, cluster: AdxCluster) -> list:
+        response = get_kusto_pool().get(cluster.uri).execute_mgmt("NetDefaultDB", ".show databases")
+        return [
+            row["DatabaseName"]
+            for row in response.primary_results[0]
+            if row["DatabaseName"].startswith(self.prefix) and not row["PrettyName"]
+        ]
+
+    def _create(self, cluster: AdxCluster) -> str:
+        database_name = f"{self.prefix}{uuid4().hex[:12]}"
+        get_kusto_client().databases.begin_create_or_update(
+            polling=AdaptiveARMPolling(),
+            resource_group_name=os.environ.get("RESOURCE_GROUP_NAME"),
+            cluster_name=cluster.name,
+            database_name=database_name,
+            parameters=database_parameters({}),
+            content_type="application/json",
+        ).result()
+        apply_policies(
+            get_kusto_pool().get(cluster.uri),
+            cluster.uri,
+            database_name,
+            f"database ['{database_name}']",
+            database_policies(database_name, {}),
+        )
+        return database_name
+
+    def _refill(self):
+        while True:
+            try:
+                for cluster in self.clusters:
+                    with self._cond:
+                        loaded = cluster.name in self._spare
+                    if not loaded:
+                        spare = self._load(cluster)
+                        with self._cond:
+                            self._spare[cluster.name] = spare
+                    with self._cond:
+                        backlog = self.size - len(self._spare[cluster.name])
+                    WARM_POOL_BACKLOG.labels(cluster.name).set(max(backlog, 0))
+                    if backlog > 0:
+                        database_name = self._create(cluster)
+                        with self._cond:
+                            self._spare[cluster.name].append(database_name)
+                            WARM_POOL_SIZE.labels(cluster.name).set(len(self._spare[cluster.name]))
+                        WARM_POOL_BACKLOG.labels(cluster.name).set(backlog - 1)
+                with self._cond:
+                    full = all(len(self._spare.get(c.name, [])) >= self.size for c in self.clusters)
+                    if full:
+                        # woken up by a claim
+                        self._cond.wait(timeout=300)
+            except Exception as e:
+                print(f"[adx] warm pool refill failed: {e}")
+                time.sleep(30)
+
+
+@functools.lru_cache(maxsize=None)
+def get_warm_pool() -> WarmPool:
+    """Warm pool of ADX_WARM_POOL_SIZE spare databases per cluster, disabled by default"""
+    return WarmPool(
+        size=int(os.environ.get("ADX_WARM_POOL_SIZE", "0")),
+        clusters=list(get_placer().clusters.values()),
+        prefix=os.environ.get("ADX_WARM_POOL_PREFIX", "warm-"),
     )
-    entity_assignments = [
-        assign for assign in assignments if assign.principal_id == principal_id
+
+
+STEP_SECONDS = Histogram(
+    "triskell_adx_step_seconds", "Duration of ADX provisioning steps", ["step"]
+)
+
+
+async def reconcile_permissions(kusto_client, adx_cluster_name: str, database_name: str, permissions: list):
+    """Lists the principal assignments once, then adds the missing ones and drops the extra ones concurrently"""
+    resource_group_name = os.environ.get("RESOURCE_GROUP_NAME")
+    desired = {
+        (per.get("principalId", ""), per.get("role", "")): per for per in permissions
+    }
+    actual = [
+        assign
+        async for assign in kusto_client.database_principal_assignments.list(
+            resource_group_name, adx_cluster_name, database_name
+        )
+    ]
+    present = {(assign.principal_id, assign.role) for assign in actual}
+    # a principal listed in the spec keeps only the roles the spec gives it
+    managed = {principal_id for principal_id, _ in desired}
+    extra = [
+        assign
+        for assign in actual
+        if assign.principal_id in managed
+        and (assign.principal_id, assign.role) not in desired
     ]
-    if not entity_assignments:
-        return None
-    for assign in entity_assignments:
-        assign_name: str = str(assign.name).split("/")[-1]
-        kusto_client.database_principal_assignments.begin_delete(
+    missing = [per for key, per in desired.items() if key not in present]
+
+    async def drop(assign):
+        poller = await kusto_client.database_principal_assignments.begin_delete(
+            polling=AsyncAdaptiveARMPolling(),
             resource_group_name=resource_group_name,
             cluster_name=adx_cluster_name,
             database_name=database_name,
-            principal_assignment_name=assign_name,
-        ).result()
+            principal_assignment_name=str(assign.name).split("/")[-1],
+        )
+        await poller.result()
 
+    async def add(per: dict):
+        poller = await kusto_client.database_principal_assignments.begin_create_or_update(
+            polling=AsyncAdaptiveARMPolling(),
+            principal_assignment_name=str(uuid4()),
+            cluster_name=adx_cluster_name,
+            resource_group_name=resource_group_name,
+            database_name=database_name,
+            parameters=DatabasePrincipalAssignment(
+                principal_id=per.get("principalId", ""),
+                principal_type=per.get("principalType", ""),
+                role=per.get("role", ""),
+                tenant_id=os.environ.get("TENANT_ID"),
+            ),
+        )
+        await poller.result()
 
-def main():
-    api_instance = client.CustomObjectsApi()
-    group = "azure.cosmotech.com"  # Update to the correct API group
-    version = "v1"  # Update to the correct API version
-    namespace = os.environ.get("NAMESPACE")  # Assuming custom resource is in default namespace
-    plural = "adxdatabases"
+    await asyncio.gather(*(drop(assign) for assign in extra), *(add(per) for per in missing))
+    print(f"[adx] permissions: {len(missing)} added, {len(extra)} dropped")
 
-    # Watch for events on custom resource
-    resource_version = ""
+
+def connection_name(orga_id: str, cn: dict) -> str:
+    """Data connection name of a spec.connectors entry, the same on every reconcile
+
+    Connectors reading the same eventhub differ by their consumer group or table.
+    """
+    key = "|".join(str(cn.get(k, "")) for k in ("connectionName", "consumerGroup", "tableName"))
+    suffix = hashlib.sha256(key.lower().encode("utf-8")).hexdigest()[:8]
+    return f"{orga_id}-{cn.get('connectionName', '')}-{suffix}".lower()
+
+
+def setting_value(value) -> str:
+    """Lower case text of a setting, the value of an SDK enum rather than its name"""
+    return str(getattr(value, "value", value) or "").lower()
+
+
+def same_connection(current, desired) -> bool:
+    for attr in (
+        "consumer_group",
+        "event_hub_resource_id",
+        "data_format",
+        "compression",
+        "table_name",
+        "managed_identity_resource_id",
+        "mapping_rule_name",
+    ):
+        wanted = getattr(desired, attr, None)
+        # settings left empty in the spec take whatever the service defaults to
+        if setting_value(wanted) and setting_value(getattr(current, attr, None)) != setting_value(wanted):
+            return False
+    return True
+
+
+async def reconcile_connections(
+    kusto_client, adx_cluster_name: str, database_name: str, orga_id: str, work_key: str, connectors: list
+):
+    """Lists the data connections once, then creates, updates and deletes only what differs concurrently"""
     subscription = os.environ.get("AZURE_SUBSCRIPTION")
-    credential = ClientSecretCredential(
-        client_id=os.environ.get("CLIENT_ID"),
-        tenant_id=os.environ.get("TENANT_ID"),
-        client_secret=os.environ.get("CLIENT_SECRET"),
+    resource_group_name = os.environ.get("RESOURCE_GROUP_NAME")
+    location = os.environ.get("LOCATION")
+    namespace_id = f"/subscriptions/{subscription}/resourceGroups/{resource_group_name}"
+    namespace_id += f"/providers/Microsoft.EventHub/namespaces/{orga_id}-{work_key}"
+    managed_id = f"/subscriptions/{subscription}/resourceGroups/{resource_group_name}"
+    managed_id += f"/providers/Microsoft.Kusto/clusters/{adx_cluster_name}"
+    names = [connection_name(orga_id, cn) for cn in connectors]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"connectors with the same eventhub, consumer group and table: {sorted(duplicates)}")
+    desired = {
+        connection_name(orga_id, cn): EventHubDataConnection(
+            consumer_group=cn.get("consumerGroup", ""),
+            location=location,
+            event_hub_resource_id=f"{namespace_id}/eventhubs/{cn.get('connectionName', '').lower()}",
+            data_format=cn.get("format"),
+            compression=str(cn.get("compression", "")),
+            table_name=cn.get("tableName", ""),
+            managed_identity_resource_id=managed_id,
+            mapping_rule_name=cn.get("mapping", ""),
+        )
+        for cn in connectors
+    }
+    actual = {
+        str(conn.name).split("/")[-1]: conn
+        async for conn in kusto_client.data_connections.list_by_database(
+            resource_group_name, adx_cluster_name, database_name
+        )
+    }
+    changed = [
+        name
+        for name, conn in desired.items()
+        if name not in actual or not same_connection(actual[name], conn)
+    ]
+    extra = [name for name in actual if name not in desired]
+
+    async def put(name: str):
+        poller = await kusto_client.data_connections.begin_create_or_update(
+            polling=AsyncAdaptiveARMPolling(),
+            resource_group_name=resource_group_name,
+            cluster_name=adx_cluster_name,
+            database_name=database_name,
+            data_connection_name=name,
+            parameters=desired[name],
+        )
+        await poller.result()
+
+    async def drop(name: str):
+        poller = await kusto_client.data_connections.begin_delete(
+            polling=AsyncAdaptiveARMPolling(),
+            resource_group_name=resource_group_name,
+            cluster_name=adx_cluster_name,
+            database_name=database_name,
+            data_connection_name=name,
+        )
+        await poller.result()
+
+    await asyncio.gather(*(put(name) for name in changed), *(drop(name) for name in extra))
+    print(f"[adx] connections: {len(changed)} created or updated, {len(extra)} deleted")
+
+
+POLICY_CACHE = {}
+POLICY_CACHE_LOCK = threading.Lock()
+# what a database reports as a null policy behaves like
+POLICY_DEFAULTS = {"streamingingestion": {"IsEnabled": False}}
+
+
+def timespan_seconds(value: str) -> float:
+    """Parses a Kusto timespan such as 365.00:00:00 or 00:00:10"""
+    hours, minutes, seconds = value.split(":")
+    days, _, hours = hours.rpartition(".")
+    return float(days or 0) * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def same_policy_value(current, desired) -> bool:
+    if isinstance(desired, dict):
+        return isinstance(current, dict) and all(
+            same_policy_value(current.get(k), v) for k, v in desired.items()
+        )
+    if isinstance(desired, list):
+        return (
+            isinstance(current, list)
+            and len(current) == len(desired)
+            and all(same_policy_value(c, d) for c, d in zip(current, desired))
+        )
+    if isinstance(current, str) and isinstance(desired, str) and ":" in desired:
+        try:
+            return timespan_seconds(current) == timespan_seconds(desired)
+        except ValueError:
+            pass
+    return current == desired
+
+
+def ingestion_policies(entity: str, ingestion: dict) -> dict:
+    """Desired streaming and batching policies of a database or table, only for the settings given,
+    as {policy kind: (policy fields, alter command)}"""
+    policies = {}
+    if "streaming" in ingestion:
+        streaming = bool(ingestion["streaming"])
+        policies["streamingingestion"] = (
+            {"IsEnabled": streaming},
+            f".alter {entity} policy streamingingestion {'enable' if streaming else 'disable'}",
+        )
+    batching = ingestion.get("batching") or {}
+    batching_policy = {}
+    if "maximumBatchingTimeSpan" in batching:
+        batching_policy["MaximumBatchingTimeSpan"] = batching["maximumBatchingTimeSpan"]
+    if "maximumNumberOfItems" in batching:
+        batching_policy["MaximumNumberOfItems"] = int(batching["maximumNumberOfItems"])
+    if "maximumRawDataSizeMB" in batching:
+        batching_policy["MaximumRawDataSizeMB"] = int(batching["maximumRawDataSizeMB"])
+    if batching_policy:
+        policies["ingestionbatching"] = (
+            batching_policy,
+            f".alter {entity} policy ingestionbatching '{json.dumps(batching_policy)}'",
+        )
+    return policies
+
+
+def database_policies(database_name: str, resource_data: dict) -> dict:
+    """Desired database policies, as {policy kind: (policy fields, alter command)}"""
+    retention = resource_data.get("retention", 365)
+    ingestion = resource_data.get("ingestion") or {}
+    # databases keep streaming off and a 10s batching window unless the spec says otherwise
+    policies = ingestion_policies(
+        f"database ['{database_name}']",
+        {
+            "streaming": ingestion.get("streaming", False),
+            "batching": {"maximumBatchingTimeSpan": "00:00:10", **(ingestion.get("batching") or {})},
+        },
     )
-    kusto_client = KustoManagementClient(
-        credential=credential,
-        subscription_id=subscription,
+    policies["retention"] = (
+        {"SoftDeletePeriod": f"{retention}.00:00:00"},
+        f".alter-merge database ['{database_name}'] policy retention softdelete = {retention}d",
     )
-    iam_client = AuthorizationManagementClient(
-        credential=credential,
-        subscription_id=subscription,
+    return policies
+
+
+def table_policies(table: dict) -> dict:
+    """Desired policies of a spec.tables entry, only for the settings it overrides
+
+    partitioning and merge are given as the Kusto policy objects, e.g. {"PartitionKeys": [...]}.
+    """
+    entity = f"table ['{table['name']}']"
+    policies = {}
+    for kind in ("partitioning", "merge"):
+        if kind in table:
+            policies[kind] = (
+                table[kind],
+                f".alter {entity} policy {kind} ```{json.dumps(table[kind])}```",
+            )
+    if "ingestion" in table:
+        policies.update(ingestion_policies(entity, table["ingestion"]))
+    if "hotCachePeriod" in table:
+        days = int(table["hotCachePeriod"])
+        policies["caching"] = (
+            {"DataHotSpan": {"Value": f"{days}.00:00:00"}},
+            f".alter {entity} policy caching hot = {days}d",
+        )
+    return policies
+
+
+def table_layout_commands(kusto_client, database_name: str, tables: list) -> list:
+    """Commands for the spec.tables columns and ingestion mappings the database does not have yet"""
+    response = kusto_client.execute_mgmt(
+        database_name, f".show database ['{database_name}'] cslschema"
     )
-    while True:
-        stream = watch.Watch().stream(
-            api_instance.list_namespaced_custom_object,
+    schemas = {
+        row["TableName"]: dict(
+            column.strip().split(":", 1) for column in row["Schema"].split(",") if column.strip()
+        )
+        for row in response.primary_results[0]
+    }
+    response = kusto_client.execute_mgmt(
+        database_name, f".show database ['{database_name}'] ingestion mappings"
+    )
+    mappings = {
+        (row["Table"], row["Name"]): (str(row["Kind"]).lower(), json.loads(row["Mapping"]))
+        for row in response.primary_results[0]
+    }
+    commands = []
+    for table in tables:
+        name = table["name"]
+        current = schemas.get(name, {})
+        columns = {column["name"]: column["type"] for column in table.get("schema") or []}
+        changed = [c for c, t in columns.items() if c in current and current[c] != t]
+        if changed:
+            print(f"[adx] {database_name} {name}: column type changes are not applied: {changed}")
+        if any(c not in current for c in columns):
+            # create-merge only adds tables and columns, it never drops data
+            schema = ", ".join(f"['{c}']:{t}" for c, t in columns.items())
+            commands.append(f".create-merge table ['{name}'] ({schema})")
+        for mapping in table.get("mappings") or []:
+            kind = mapping.get("kind", "json").lower()
+            existing = mappings.get((name, mapping["name"]))
+            if existing and existing[0] == kind and same_policy_value(existing[1], mapping["mapping"]):
+                continue
+            commands.append(
+                f".create-or-alter table ['{name}'] ingestion {kind} mapping "
+                f"'{mapping['name']}' '{json.dumps(mapping['mapping'])}'"
+            )
+    return commands
+
+
+def raise_failed_commands(response, what: str):
+    """.execute database script reports failed commands in its rows instead of raising"""
+    failed = [row for row in response.primary_results[0] if row["Result"] != "Completed"]
+    if failed:
+        raise RuntimeError(
+            f"{what}: {len(failed)} command(s) not completed, first: "
+            f"{failed[0]['Result']} {failed[0]['Reason']} ({str(failed[0]['CommandText'])[:200]})"
+        )
+
+
+def apply_table_layout(kusto_client, database_name: str, tables: list):
+    commands = table_layout_commands(kusto_client, database_name, tables)
+    if not commands:
+        print(f"[adx] {database_name} tables already up to date")
+        return
+    script_content = ".execute database script <|\n" + "\n\n".join(commands)
+    response = kusto_client.execute_mgmt(database_name, script_content)
+    raise_failed_commands(response, f"{database_name} tables")
+    print(f"[adx] {database_name} table commands applied: {len(commands)}")
+
+
+def show_policies(kusto_client, uri: str, database_name: str, entity: str, kinds: list) -> dict:
+    """Current policies of a database or table, cached for ADX_POLICY_CACHE_SECONDS"""
+    ttl = float(os.environ.get("ADX_POLICY_CACHE_SECONDS", "600"))
+    with POLICY_CACHE_LOCK:
+        cached = POLICY_CACHE.get((uri, database_name, entity))
+    if cached and time.monotonic() - cached[0] < ttl and all(k in cached[1] for k in kinds):
+        return cached[1]
+    policies = {}
+    for kind in kinds:
+        response = kusto_client.execute_mgmt(
+            database_name, f".show {entity} policy {kind}"
+        )
+        rows = list(response.primary_results[0])
+        # a policy that was never set is reported as null
+        policy = (json.loads(rows[0]["Policy"] or "null") if rows else None) or {}
+        policies[kind] = {**POLICY_DEFAULTS.get(kind, {}), **policy}
+    with POLICY_CACHE_LOCK:
+        POLICY_CACHE[(uri, database_name, entity)] = (time.monotonic(), policies)
+    return policies
+
+
+def apply_policies(kusto_client, uri: str, database_name: str, entity: str, desired: dict):
+    """Sends only the alter commands whose policy differs from what the database or table already has"""
+    if not desired:
+        return
+    current = show_policies(kusto_client, uri, database_name, entity, list(desired))
+    commands = [
+        command
+        for kind, (fields, command) in desired.items()
+        if not same_policy_value(current[kind], fields)
+    ]
+    if not commands:
+        print(f"[adx] {database_name} {entity} policies already up to date")
+        return
+    script_content = ".execute database script <|\n" + "\n\n".join(commands)
+    try:
+        response = kusto_client.execute_mgmt(database_name, script_content)
+        raise_failed_commands(response, f"{database_name} {entity} policies")
+    except Exception:
+        # what the database has now is unknown, it is read again on the retry
+        with POLICY_CACHE_LOCK:
+            POLICY_CACHE.pop((uri, database_name, entity), None)
+        raise
+    with POLICY_CACHE_LOCK:
+        cached = POLICY_CACHE.get((uri, database_name, entity))
+        if cached:
+            for kind, (fields, _) in desired.items():
+                cached[1][kind].update(fields)
+    print(f"[adx] {database_name} {entity} policies altered: {len(commands)}")
+
+
+def command_count(content: str) -> int:
+    """Number of control commands in a script, each one starts on a line beginning with a dot"""
+    return sum(1 for line in content.splitlines() if line.lstrip().startswith("."))
+
+
+def script_statuses(batch: list, rows) -> list:
+    """Maps the per-command rows of a script batch back to the scripts they came from
+
+    The rows come one per command in script order, so each script owns the next command_count rows.
+    """
+    rows = list(rows)
+    counts = [command_count(sc.get("content", "")) for sc in batch]
+    if sum(counts) != len(rows):
+        # the commands cannot be told apart, only report a failure against the whole batch
+        failed = [row for row in rows if row["Result"] != "Completed"]
+        if not failed:
+            return [{"result": "Completed", "reason": ""} for _ in batch]
+        reason = f"batch of {len(batch)} scripts had a failure: {failed[0]['Reason']}"
+        return [{"result": failed[0]["Result"], "reason": reason} for _ in batch]
+    statuses = []
+    start = 0
+    for count in counts:
+        # keep the first failure of a script
+        failed = [row for row in rows[start:start + count] if row["Result"] != "Completed"]
+        statuses.append(
+            {"result": failed[0]["Result"], "reason": failed[0]["Reason"]}
+            if failed else {"result": "Completed", "reason": ""}
+        )
+        start += count
+    return statuses
+
+
+def execute_scripts(kusto_client, database_name: str, scripts: list, batch_size: int) -> list:
+    """Runs the scripts as `.execute database script` batches and returns one status per script"""
+    statuses = []
+    for start in range(0, len(scripts), batch_size):
+        batch = scripts[start:start + batch_size]
+        body = "\n\n".join(sc.get("content", "").strip() for sc in batch)
+        query = f".execute database script with (ContinueOnErrors=true) <|\n{body}"
+        try:
+            response = kusto_client.execute_mgmt(database_name, query)
+            statuses += script_statuses(batch, response.primary_results[0])
+        except Exception as e:
+            print(e)
+            statuses += [{"result": "Failed", "reason": str(e)} for _ in batch]
+    return [
+        dict(name=sc.get("name", str(i)), **st)
+        for i, (sc, st) in enumerate(zip(scripts, statuses))
+    ]
+
+
+async def run_steps(steps: dict):
+    """Runs every step once the steps it depends on are done, ADX_CONCURRENCY at a time
+
+    steps maps a step name to (dependencies, coroutine function), dependencies declared first
+    """
+    semaphore = asyncio.Semaphore(int(os.environ.get("ADX_CONCURRENCY", "8")))
+    tasks = {}
+
+    async def run(name: str, deps: list, func):
+        await asyncio.gather(*(tasks[d] for d in deps))
+        async with semaphore:
+            start = time.monotonic()
+            await func()
+            elapsed = time.monotonic() - start
+        STEP_SECONDS.labels(name.split(":")[0]).observe(elapsed)
+        print(f"[adx] {name} done in {elapsed:.1f}s")
+
+    for name, (deps, func) in steps.items():
+        tasks[name] = asyncio.ensure_future(run(name, deps, func))
+    results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+        raise errors[0]
+
+
+async def provision_database(
+    cluster: AdxCluster,
+    database_name: str,
+    orga_id: str,
+    work_key: str,
+    resource_data: dict,
+    modified: bool = False,
+    warm: bool = False,
+):
+    """Creates the database and everything attached to it as a graph of concurrent steps, returns status fields
+
+    On MODIFIED only the database settings, spec.tables, the data connections and the policies are applied again.
+    A warm database was claimed from the pool and already exists with the default settings.
+    """
+    status = {"cluster": cluster.name}
+    subscription = os.environ.get("AZURE_SUBSCRIPTION")
+    resource_group_name = os.environ.get("RESOURCE_GROUP_NAME")
+    adx_cluster_name = cluster.name
+    retention = resource_data.get("retention", 365)
+    uri = await asyncio.to_thread(getattr, cluster, "uri")
+    kusto_client_new = get_kusto_pool().get(uri)
+    kusto_client = get_async_azure().kusto_client
+    iam_client = get_async_azure().iam_client
+
+    async def create_database():
+        if warm and not modified and retention == 365 and resource_data.get("hotCachePeriod", 31) == 31:
+            return
+        poller = await kusto_client.databases.begin_create_or_update(
+            polling=AsyncAdaptiveARMPolling(),
+            resource_group_name=resource_group_name,
+            cluster_name=adx_cluster_name,
+            database_name=database_name,
+            parameters=database_parameters(resource_data),
+            content_type="application/json",
+        )
+        await poller.result()
+
+    async def permissions():
+        await reconcile_permissions(
+            kusto_client,
+            adx_cluster_name,
+            database_name=database_name,
+            permissions=resource_data.get("permissions") or [],
+        )
+
+    def assign_role(principal_id: str, role_id: str):
+        async def step():
+            resource_type = "Microsoft.EventHub/Namespaces"
+            prefix = f"/subscriptions/{subscription}"
+            scope = f"{prefix}/resourceGroups/{resource_group_name}/providers/{resource_type}/{orga_id}-{work_key}"
+            role = f"{prefix}/providers/Microsoft.Authorization/roleDefinitions/{role_id}"
+            try:
+                await iam_client.role_assignments.create(
+                    scope=scope,
+                    role_assignment_name=str(uuid4()),
+                    parameters=RoleAssignmentCreateParameters(
+                        role_definition_id=role,
+                        principal_id=principal_id,
+                        principal_type="ServicePrincipal",
+                    ),
+                )
+            except Exception as e:
+                print(e)
+
+        return step
+
+    async def alter_database():
+        await asyncio.to_thread(
+            apply_policies,
+            kusto_client_new,
+            uri,
+            database_name,
+            f"database ['{database_name}']",
+            database_policies(database_name, resource_data),
+        )
+
+    async def table_layout():
+        await asyncio.to_thread(
+            apply_table_layout,
+            kusto_client_new,
+            database_name,
+            resource_data.get("tables") or [],
+        )
+
+    def alter_table(table: dict):
+        async def step():
+            await asyncio.to_thread(
+                apply_policies,
+                kusto_client_new,
+                uri,
+                database_name,
+                f"table ['{table['name']}']",
+                table_policies(table),
+            )
+
+        return step
+
+    async def scripts():
+        status["scripts"] = await asyncio.to_thread(
+            execute_scripts,
+            kusto_client_new,
+            database_name,
+            resource_data.get("scripts") or [],
+            int(resource_data.get("scriptBatchSize", os.environ.get("ADX_SCRIPT_BATCH_SIZE", "20"))),
+        )
+
+    async def connectors():
+        await reconcile_connections(
+            kusto_client,
+            adx_cluster_name,
+            database_name,
+            orga_id,
+            work_key,
+            resource_data.get("connectors") or [],
+        )
+
+    steps = {"database": ([], create_database)}
+    steps["policies"] = (["database"], alter_database)
+    if not modified:
+        steps["permissions"] = (["database"], permissions)
+        steps["role:receiver"] = (
+            [],
+            assign_role(
+                await asyncio.to_thread(getattr, cluster, "principal_id"),
+                os.environ.get("EVENTHUB_BUILT_DATA_RECEIVER", "a638d3c7-ab3a-418d-83e6-5f17a39d4fde"),
+            ),
+        )
+        steps["role:sender"] = (
+            [],
+            assign_role(
+                os.environ.get("PLATFORM_PRINCIPAL_ID"),
+                os.environ.get("EVENTHUB_BUILT_DATA_SENDER", "2b629674-e913-4c01-ae53-ef4638d8f975"),
+            ),
+        )
+        steps["scripts"] = (["policies"], scripts)
+    # spec.tables come after the scripts, which may create tables of their own
+    steps["tables"] = (["policies"] if modified else ["scripts"], table_layout)
+    for table in resource_data.get("tables") or []:
+        steps[f"table:{table['name']}"] = (["tables"], alter_table(table))
+    steps["connectors"] = (["tables"] if modified else ["tables", "role:receiver"], connectors)
+    await run_steps(steps)
+    return status
+
+
+class WorkQueue:
+    """Hands watch events to a pool of workers, keeping the events of one resource in order"""
+
+    def __init__(self, handler, workers: int = 0):
+        self.handler = handler
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._ready = collections.deque()
+        self._busy = set()
+        for i in range(workers or int(os.environ.get("WORKERS", "4"))):
+            threading.Thread(target=self._work, name=f"worker-{i}", daemon=True).start()
+
+    def add(self, key: str, event: dict):
+        with self._cond:
+            # a key already pending or being reconciled is picked up again by its worker
+            if key not in self._pending and key not in self._busy:
+                self._ready.append(key)
+                self._cond.notify()
+            self._pending.setdefault(key, []).append(event)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                key = self._ready.popleft()
+                events = self._pending.pop(key)
+                self._busy.add(key)
+            for event in events:
+                try:
+                    self.handler(event)
+                except Exception as e:
+                    print("Exception when reconciling %s: %s\n" % (key, e))
+            with self._cond:
+                self._busy.discard(key)
+                if key in self._pending:
+                    self._ready.append(key)
+                    self._cond.notify()
+
+
+FINALIZER = "azure.cosmotech.com/adxdatabase"
+LRO_IN_FLIGHT = Gauge("triskell_lro_in_flight", "Long running operations followed by the tracker")
+
+
+class LroTracker:
+    """Follows long running operations from one thread and calls back once each one is done"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._operations = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, name="lro-tracker", daemon=True).start()
+
+    def tracking(self, key: str) -> bool:
+        with self._lock:
+            return key in self._operations
+
+    def track(self, key: str, poller, done, failed):
+        with self._lock:
+            self._operations[key] = (poller, done, failed)
+            LRO_IN_FLIGHT.set(len(self._operations))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                finished = {k: op for k, op in self._operations.items() if op[0].done()}
+                for key in finished:
+                    del self._operations[key]
+                LRO_IN_FLIGHT.set(len(self._operations))
+            for key, (poller, done, failed) in finished.items():
+                try:
+                    poller.result()
+                except Exception as e:
+                    print(f"Operation {key} failed: {e}")
+                    callback = functools.partial(failed, e)
+                else:
+                    callback = done
+                try:
+                    callback()
+                except Exception as e:
+                    print("Exception when completing %s: %s\n" % (key, e))
+
+
+@functools.lru_cache(maxsize=None)
+def get_lro_tracker() -> LroTracker:
+    return LroTracker(interval=float(os.environ.get("LRO_TRACK_INTERVAL", "1")))
+
+
+def set_finalizer(api_instance, group: str, version: str, namespace: str, plural: str, name: str, present: bool):
+    """Adds or removes the finalizer of the controller, leaving the other finalizers alone"""
+    try:
+        current = api_instance.get_namespaced_custom_object(group, version, namespace, plural, name)
+    except ApiException as e:
+        if e.status == 404:
+            return
+        raise
+    finalizers = [f for f in current["metadata"].get("finalizers") or [] if f != FINALIZER]
+    if present:
+        finalizers.append(FINALIZER)
+    api_instance.patch_namespaced_custom_object(
+        group,
+        version,
+        namespace,
+        plural,
+        name,
+        # the resource version makes a concurrent change of the finalizers fail instead of being lost
+        {"metadata": {"finalizers": finalizers, "resourceVersion": current["metadata"]["resourceVersion"]}},
+    )
+
+
+DELETE_RETRIES = {}
+DELETE_RETRIES_LOCK = threading.Lock()
+
+
+def retry_delete(api_instance, group: str, version: str, namespace: str, plural: str, name: str, retry_at: float):
+    """Starts the delete of the resource again at retry_at, one pending retry per resource"""
+
+    def retry():
+        with DELETE_RETRIES_LOCK:
+            DELETE_RETRIES.pop(name, None)
+        try:
+            current = api_instance.get_namespaced_custom_object(group, version, namespace, plural, name)
+            if "deletionTimestamp" in current["metadata"]:
+                start_delete(api_instance, group, version, namespace, plural, current)
+        except ApiException as e:
+            if e.status != 404:
+                print("Exception when retrying delete of %s: %s\n" % (name, e))
+        except Exception as e:
+            print("Exception when retrying delete of %s: %s\n" % (name, e))
+
+    with DELETE_RETRIES_LOCK:
+        if name in DELETE_RETRIES:
+            return
+        timer = threading.Timer(max(retry_at - time.time(), 0), retry)
+        timer.daemon = True
+        DELETE_RETRIES[name] = timer
+    timer.start()
+
+
+def start_delete(api_instance, group: str, version: str, namespace: str, plural: str, custom_resource: dict):
+    """Starts deleting the azure resource, or resumes from the poller token kept in the status
+
+    The finalizer is removed by the tracker once the delete is done. A failed delete clears the token and
+    records the error, the attempts and the time of the next attempt, DELETE_RETRY_INITIAL seconds doubled
+    on every failure up to DELETE_RETRY_MAX; events until then do not start it again.
+    """
+    name = custom_resource["metadata"]["name"]
+    status = custom_resource.get("status") or {}
+    if get_lro_tracker().tracking(name):
+        return
+    if not custom_resource["spec"].get("id"):
+        # nothing was provisioned
+        set_finalizer(api_instance, group, version, namespace, plural, name, False)
+        return
+    deletion = status.get("deletion") or {}
+    if deletion.get("retryAt") and deletion["retryAt"] > time.time():
+        # the previous attempt failed, the MODIFIED event of its status does not start it again
+        retry_delete(api_instance, group, version, namespace, plural, name, deletion["retryAt"])
+        return
+
+    def failed(e: Exception):
+        attempts = int(deletion.get("attempts", 0)) + 1
+        delay = min(
+            float(os.environ.get("DELETE_RETRY_INITIAL", "30")) * 2 ** (attempts - 1),
+            float(os.environ.get("DELETE_RETRY_MAX", "900")),
+        )
+        print(f"Delete of {name} failed {attempts} time(s), next attempt in {delay:.0f}s: {e}")
+        api_instance.patch_namespaced_custom_object_status(
+            group,
+            version,
+            namespace,
+            plural,
+            name,
+            {
+                "status": {
+                    "deletion": {
+                        "state": "Failed",
+                        "token": None,
+                        "error": str(e),
+                        "attempts": attempts,
+                        "retryAt": time.time() + delay,
+                    }
+                }
+            },
+        )
+        retry_delete(api_instance, group, version, namespace, plural, name, time.time() + delay)
+
+    token = deletion.get("token")
+    try:
+        poller = delete_obj(custom_resource, continuation_token=token)
+    except Exception as e:
+        failed(e)
+        return
+    if not token:
+        api_instance.patch_namespaced_custom_object_status(
             group,
             version,
             namespace,
             plural,
-            resource_version=resource_version,
-        )
-        for event in stream:
-            custom_resource = event["object"]
-            event_type = event["type"]
-            # Extract custom resource name
-            resource_name = custom_resource["metadata"]["name"]
-            organization_name = (
-                custom_resource["spec"].get("selector", {}).get("organization", "")
+            name,
+            {"status": {"deletion": {"state": "Deleting", "token": poller.continuation_token()}}},
+        )
+
+    def done():
+        print(f"Deleted {custom_resource['spec']['id']}")
+        set_finalizer(api_instance, group, version, namespace, plural, name, False)
+
+    get_lro_tracker().track(name, poller, done, failed)
+
+
+def spec_hash(spec: dict) -> str:
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# generation and spec hash applied by this process, by uid, ahead of the status update
+APPLIED = {}
+
+
+def is_reconciled(custom_resource: dict) -> bool:
+    """True when this generation and spec were already applied, according to the status or to this process"""
+    status = custom_resource.get("status") or {}
+    current = (
+        custom_resource["metadata"].get("generation"),
+        spec_hash(custom_resource.get("spec", {})),
+    )
+    return current in (
+        (status.get("observedGeneration"), status.get("specHash")),
+        APPLIED.get(custom_resource["metadata"].get("uid")),
+    )
+
+
+def record_applied(
+    api_instance, group: str, version: str, namespace: str, plural: str, custom_resource: dict, status: dict = None
+):
+    """Stores the generation and spec hash just applied, plus any extra status fields, in the status subresource"""
+    APPLIED[custom_resource["metadata"].get("uid")] = (
+        custom_resource["metadata"].get("generation"),
+        spec_hash(custom_resource.get("spec", {})),
+    )
+    try:
+        api_instance.patch_namespaced_custom_object_status(
+            group,
+            version,
+            namespace,
+            plural,
+            custom_resource["metadata"]["name"],
+            {
+                "status": {
+                    "observedGeneration": custom_resource["metadata"].get("generation"),
+                    "specHash": spec_hash(custom_resource.get("spec", {})),
+                    **(status or {}),
+                }
+            },
+        )
+    except ApiException as e:
+        print("Exception when calling patch status: %s\n" % e)
+
+
+def place_database(api_instance, group, version, namespace, plural, custom_resource: dict, pretty_name: str):
+    """Cluster and database of the resource, returned with whether the database came from the warm pool
+
+    A new resource is placed on a cluster and claims a spare database when the pool has one;
+    both are recorded in the status before provisioning so a retry goes to the same database.
+    """
+    placer = get_placer()
+    status = custom_resource.get("status") or {}
+    recorded = custom_resource["spec"].get("id") or status.get("database")
+    if status.get("cluster"):
+        database_name = recorded or pretty_name
+        return placer.cluster(status["cluster"]), database_name, database_name != pretty_name
+    if recorded:
+        # provisioned before clusters were recorded
+        return placer.cluster(os.environ.get("ADX_CLUSTER_NAME")), recorded, False
+    cluster = placer.place(custom_resource["spec"].get("cluster", ""))
+    database_name = get_warm_pool().claim(cluster, pretty_name) or pretty_name
+    api_instance.patch_namespaced_custom_object_status(
+        group,
+        version,
+        namespace,
+        plural,
+        custom_resource["metadata"]["name"],
+        {"status": {"cluster": cluster.name, "database": database_name}},
+    )
+    return cluster, database_name, database_name != pretty_name
+
+
+def reconcile(event: dict):
+    api_instance = client.CustomObjectsApi()
+    group = "azure.cosmotech.com"  # Update to the correct API group
+    version = "v1"  # Update to the correct API version
+    namespace = os.environ.get("NAMESPACE")  # Assuming custom resource is in default namespace
+    plural = "adxdatabases"
+    custom_resource = event["object"]
+    event_type = event["type"]
+    if event_type in ("ADDED", "MODIFIED"):
+        if "deletionTimestamp" in custom_resource["metadata"]:
+            if FINALIZER in (custom_resource["metadata"].get("finalizers") or []):
+                start_delete(api_instance, group, version, namespace, plural, custom_resource)
+            return
+        if FINALIZER not in (custom_resource["metadata"].get("finalizers") or []):
+            set_finalizer(api_instance, group, version, namespace, plural, custom_resource["metadata"]["name"], True)
+    if event_type in ("ADDED", "MODIFIED") and is_reconciled(custom_resource):
+        # already applied by a previous run of the controller
+        return
+    # Extract custom resource name
+    resource_name = custom_resource["metadata"]["name"]
+    organization_name = (
+        custom_resource["spec"].get("selector", {}).get("organization", "")
+    )
+    workspace_name = (
+        custom_resource["spec"].get("selector", {}).get("workspace", "")
+    )
+    # Extract key-value pairs from the custom resource spec
+    resource_data = custom_resource.get("spec", {})
+    if event_type == "MODIFIED" and not resource_data.get("id"):
+        # not provisioned yet, the ADDED event takes care of it
+        return
+    # Handle events of type ADDED (resource created) and MODIFIED (settings changed)
+    if event_type in ("ADDED", "MODIFIED"):
+        orga_id = get_org_id_by_name(organization_name=organization_name)
+        work_key = get_work_key_by_name(workspace_name=workspace_name)
+        if orga_id and work_key:
+            cluster, database_name, warm = place_database(
+                api_instance, group, version, namespace, plural, custom_resource, f"{orga_id}-{work_key}"
             )
-            workspace_name = (
-                custom_resource["spec"].get("selector", {}).get("workspace", "")
+            status = get_async_azure().run(
+                provision_database(
+                    cluster=cluster,
+                    database_name=database_name,
+                    orga_id=orga_id,
+                    work_key=work_key,
+                    resource_data=resource_data,
+                    modified=event_type == "MODIFIED",
+                    warm=warm,
+                )
             )
-            # Extract key-value pairs from the custom resource spec
-            resource_data = custom_resource.get("spec", {})
-            # Handle events of type ADDED (resource created)
-            if event_type == "ADDED":
-                orga_id = get_org_id_by_name(organization_name=organization_name)
-                work_key = get_work_key_by_name(workspace_name=workspace_name)
-                if orga_id and work_key:
-                    resource_group_name = os.environ.get("RESOURCE_GROUP_NAME")
-                    database_name = f"{orga_id}-{work_key}"
-                    location = os.environ.get("LOCATION")
-                    adx_cluster_name = os.environ.get("ADX_CLUSTER_NAME")
-                    retention = resource_data.get("retention", 365)
-
-                    # cache period by default 31 days
-                    params_database = ReadWriteDatabase(
-                        location=location,
-                        soft_delete_period=timedelta(days=retention),
-                        hot_cache_period=timedelta(days=31),
-                    )
-                    kusto_client.databases.begin_create_or_update(
-                        resource_group_name=resource_group_name,
-                        cluster_name=adx_cluster_name,
-                        database_name=database_name,
-                        parameters=params_database,
-                        content_type="application/json",
-                    ).result()
-                    if resource_data.get("permissions"):
-                        for per in resource_data.get("permissions"):
-                            delete_permission(
-                                principal_id=per.get("principalId"),
-                                database_name=database_name,
-                            )
-                            name = str(uuid4())
-                            parameters = DatabasePrincipalAssignment(
-                                principal_id=per.get("principalId", ""),
-                                principal_type=per.get("principalType", ""),
-                                role=per.get("role", ""),
-                                tenant_id=os.environ.get("TENANT_ID"),
-                            )
-                            kusto_client.database_principal_assignments.begin_create_or_update(
-                                principal_assignment_name=name,
-                                cluster_name=adx_cluster_name,
-                                resource_group_name=resource_group_name,
-                                database_name=database_name,
-                                parameters=parameters,
-                            ).result()
-                            print("permission added")
-                    principal_id = os.environ.get("ADX_CLUSTER_PRINCIPAL_ID")
-                    resource_type = "Microsoft.EventHub/Namespaces"
-                    role_id = os.environ.get("EVENTHUB_BUILT_DATA_RECEIVER", 'a638d3c7-ab3a-418d-83e6-5f17a39d4fde')
-                    prefix = f"/subscriptions/{subscription}"
-                    scope = f"{prefix}/resourceGroups/{resource_group_name}/providers/{resource_type}/{orga_id}-{work_key}"
-                    role = f"{prefix}/providers/Microsoft.Authorization/roleDefinitions/{role_id}"
-                    try:
-
-                        iam_client.role_assignments.create(
-                            scope=scope,
-                            role_assignment_name=str(uuid4()),
-                            parameters=RoleAssignmentCreateParameters(
-                                role_definition_id=role,
-                                principal_id=principal_id,
-                                principal_type="ServicePrincipal",
-                            ),
-                        )
-                    except Exception as e:
-                        print(e)
-
-                    principal_id = os.environ.get("PLATFORM_PRINCIPAL_ID")
-                    resource_type = "Microsoft.EventHub/Namespaces"
-                    role_id = os.environ.get("EVENTHUB_BUILT_DATA_SENDER", "2b629674-e913-4c01-ae53-ef4638d8f975")
-                    prefix = f"/subscriptions/{subscription}"
-                    scope = f"{prefix}/resourceGroups/{resource_group_name}/providers/{resource_type}/{orga_id}-{work_key}"
-                    role = f"{prefix}/providers/Microsoft.Authorization/roleDefinitions/{role_id}"
-                    try:
-                        iam_client.role_assignments.create(
-                            scope=scope,
-                            role_assignment_name=str(uuid4()),
-                            parameters=RoleAssignmentCreateParameters(
-                                role_definition_id=role,
-                                principal_id=principal_id,
-                                principal_type="ServicePrincipal",
-                            ),
-                        )
-                    except Exception as e:
-                        print(e)
-
-                    database_uri = resource_data.get("uri")
-                    kbsc = KustoConnectionStringBuilder.with_aad_application_key_authentication(
-                        aad_app_id=os.environ.get("CLIENT_ID"),
-                        app_key=os.environ.get("CLIENT_SECRET"),
-                        authority_id=os.environ.get("TENANT_ID"),
-                        connection_string=database_uri,
-                    )
-                    kusto_client_new = KustoClient(kcsb=kbsc)
-                    batching_policy = json.dumps(
-                        {"MaximumBatchingTimeSpan": "00:00:10"}
-                    )
-                    script_content = f"""
-    .execute database script <|
-    //
-    .alter database ['{database_name}'] policy streamingingestion disable
-    //
-    .alter-merge database ['{database_name}'] policy retention softdelete = {retention}d
-    //
-    .alter database ['{database_name}'] policy ingestionbatching '{batching_policy}'
-    """
-                    ss = kusto_client_new.execute_mgmt(
-                        database=database_name, query=script_content
-                    )
-                    ss.primary_results
-                    print("script alter database ran successfully")
-                    for sc in resource_data.get("scripts"):
-                        try:
-                            s = kusto_client_new.execute_mgmt(
-                                database=database_name, query=sc.get("content")
-                            )
-                            s.primary_results
-                            print("script ran successfully")
-                        except Exception as e:
-                            print(e)
-
-                    for cn in resource_data.get("connectors"):
-                        eventhub_id = f"/subscriptions/{subscription}/"
-                        eventhub_id += f"resourceGroups/{resource_group_name}/"
-                        eventhub_id += f"providers/Microsoft.EventHub/namespaces/{orga_id}-{work_key}/"
-                        eventhub_id += (
-                            f"eventhubs/{cn.get('connectionName', '').lower()}"
-                        )
-                        managed_id = f"/subscriptions/{subscription}/resourceGroups/{resource_group_name}"
-                        managed_id += (
-                            f"/providers/Microsoft.Kusto/clusters/{adx_cluster_name}"
-                        )
-                        random_ = str(uuid4())
-                        kusto_client.data_connections.begin_create_or_update(
-                            resource_group_name=resource_group_name,
-                            cluster_name=adx_cluster_name,
-                            database_name=database_name,
-                            data_connection_name=f"{orga_id}-{random_[0:3]}-{cn.get('connectionName', '')}".lower(),
-                            parameters=EventHubDataConnection(
-                                consumer_group=cn.get("consumerGroup", ""),
-                                location=os.environ.get("LOCATION"),
-                                event_hub_resource_id=eventhub_id,
-                                data_format=cn.get("format"),
-                                compression=str(cn.get("compression", "")),
-                                table_name=cn.get("tableName", ""),
-                                managed_identity_resource_id=managed_id,
-                                mapping_rule_name=cn.get("mapping", ""),
-                            ),
-                        ).result()
-
-                    try:
-                        del resource_data["selector"]
-                        custom_resource["spec"]["id"] = database_name
-                        api_instance.patch_namespaced_custom_object(
-                            group,
-                            version,
-                            namespace,
-                            plural,
-                            resource_name,
-                            custom_resource,
-                        )
-                    except ApiException as e:
-                        print("Exception when calling patch: %s\n" % e)
-            # Handle events of type DELETED (resource deleted)
-            elif event_type == "DELETED":
-                orga_id = get_org_id_by_name(organization_name=organization_name)
-                work_key = get_work_key_by_name(workspace_name=workspace_name)
-                delete_obj(database_name=f"{orga_id}-{work_key}")
-            # Update resource_version to resume watching from the last event
-            resource_version = custom_resource["metadata"]["resourceVersion"]
+            status["database"] = database_name
+            if event_type == "MODIFIED":
+                record_applied(api_instance, group, version, namespace, plural, custom_resource, status)
+                return
+            try:
+                del resource_data["selector"]
+                custom_resource["spec"]["id"] = database_name
+                # the spec only, metadata has moved on with the status and the finalizer
+                api_response = api_instance.patch_namespaced_custom_object(
+                    group,
+                    version,
+                    namespace,
+                    plural,
+                    resource_name,
+                    {"spec": custom_resource["spec"]},
+                )
+                record_applied(api_instance, group, version, namespace, plural, api_response, status)
+            except ApiException as e:
+                print("Exception when calling patch: %s\n" % e)
+    # Handle events of type DELETED (resource deleted)
+    # the finalizer has been removed by the tracker, only resources that never got it are left to delete
+    elif event_type == "DELETED" and resource_data.get("id") and "deletion" not in (custom_resource.get("status") or {}):
+        delete_obj(custom_resource)
+
+
+WATCH_RECONNECTS = Counter(
+    "triskell_watch_reconnects_total", "Watch streams reopened", ["plural"]
+)
+RELIST_SECONDS = Histogram(
+    "triskell_watch_relist_seconds", "Duration of full relists", ["plural"]
+)
+
+
+def relist(api_instance, group: str, version: str, namespace: str, plural: str, known: dict, work_queue) -> str:
+    """Lists the custom resources and queues only the ones that changed since they were last seen"""
+    start = time.monotonic()
+    response = api_instance.list_namespaced_custom_object(group, version, namespace, plural)
+    items = {item["metadata"]["name"]: item for item in response.get("items", [])}
+    previous = dict(known)
+    known.clear()
+    known.update({name: copy.deepcopy(item) for name, item in items.items()})
+    for name, item in items.items():
+        if name not in previous:
+            work_queue.add(name, {"type": "ADDED", "object": item})
+        elif previous[name]["metadata"]["resourceVersion"] != item["metadata"]["resourceVersion"]:
+            work_queue.add(name, {"type": "MODIFIED", "object": item})
+    for name in set(previous) - set(items):
+        work_queue.add(name, {"type": "DELETED", "object": previous[name]})
+    RELIST_SECONDS.labels(plural).observe(time.monotonic() - start)
+    return response["metadata"]["resourceVersion"]
+
+
+def main():
+    api_instance = client.CustomObjectsApi()
+    group = "azure.cosmotech.com"  # Update to the correct API group
+    version = "v1"  # Update to the correct API version
+    namespace = os.environ.get("NAMESPACE")  # Assuming custom resource is in default namespace
+    plural = "adxdatabases"
+    work_queue = WorkQueue(handler=reconcile)
+    # Watch for events on custom resource
+    known = {}
+    resource_version = ""
+    while True:
+        try:
+            if not resource_version:
+                resource_version = relist(
+                    api_instance, group, version, namespace, plural, known, work_queue
+                )
+            stream = watch.Watch().stream(
+                api_instance.list_namespaced_custom_object,
+                group,
+                version,
+                namespace,
+                plural,
+                resource_version=resource_version,
+                allow_watch_bookmarks=True,
+                timeout_seconds=int(os.environ.get("WATCH_TIMEOUT_SECONDS", "300")),
+            )
+            for event in stream:
+                if not event:
+                    continue
+                custom_resource = event["object"]
+                # Update resource_version to resume watching from the last event
+                resource_version = custom_resource["metadata"]["resourceVersion"]
+                if event["type"] == "BOOKMARK":
+                    continue
+                resource_name = custom_resource["metadata"]["name"]
+                if event["type"] == "DELETED":
+                    known.pop(resource_name, None)
+                else:
+                    known[resource_name] = copy.deepcopy(custom_resource)
+                work_queue.add(resource_name, event)
+        except ApiException as e:
+            if e.status == 410:
+                # resourceVersion expired, relist and queue only what changed
+                resource_version = ""
+            else:
+                print("Exception when watching %s: %s\n" % (plural, e))
+                time.sleep(1)
+        except Exception as e:
+            # dropped connections and undecodable events, resume from the last resourceVersion seen
+            print("Exception when watching %s: %s\n" % (plural, e))
+            time.sleep(1)
+        WATCH_RECONNECTS.labels(plural).inc()
 
 
 def check_env():
@@ -354,4 +1669,12 @@ def check_env():
 if __name__ == "__main__":
     check_env()
     config.load_incluster_config()  # Use in-cluster configuration
-    main()
+    start_http_server(int(os.environ.get("METRICS_PORT", "8000")))
+    get_warm_pool()
+    # SIGTERM unwinds main so that the shared clients get closed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        main()
+    finally:
+        if ASYNC_AZURE is not None:
+            ASYNC_AZURE.close()
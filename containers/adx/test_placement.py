@@ -0,0 +1,79 @@
+import importlib.util
+import pathlib
+
+import pytest
+from prometheus_client import REGISTRY
+from prometheus_client.metrics import MetricWrapperBase
+
+spec = importlib.util.spec_from_file_location("adx_main", pathlib.Path(__file__).with_name("main.py"))
+adx = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(adx)
+# every controller registers the same metric names, free them for the tests of the others
+for value in list(vars(adx).values()):
+    if isinstance(value, MetricWrapperBase):
+        REGISTRY.unregister(value)
+
+
+def stub_probe(signals: dict):
+    """Probe returning fixed signals per cluster name, raising for the ones given as an exception"""
+    calls = []
+
+    def probe(cluster):
+        calls.append(cluster.name)
+        if isinstance(signals[cluster.name], Exception):
+            raise signals[cluster.name]
+        return dict(signals[cluster.name])
+
+    probe.calls = calls
+    return probe
+
+
+def placer(signals: dict, probe=None) -> adx.ClusterPlacer:
+    clusters = [adx.AdxCluster(name, f"https://{name}.kusto.windows.net") for name in signals]
+    return adx.ClusterPlacer(clusters, probe=probe or stub_probe(signals))
+
+
+def test_least_loaded_cluster_is_picked():
+    placement = placer({
+        "busy": {"ingestion": 0.9, "databases": 3},
+        "idle": {"ingestion": 0.1, "databases": 40},
+        "full": {"ingestion": 0.9, "databases": 1},
+    })
+    assert placement.place().name == "idle"
+
+
+def test_database_count_breaks_ingestion_ties_and_burst_spreads():
+    placement = placer({
+        "a": {"ingestion": 0.5, "databases": 2},
+        "b": {"ingestion": 0.5, "databases": 3},
+    })
+    # the database placed on a is counted right away, the next one goes to b
+    assert [placement.place().name for _ in range(3)] == ["a", "a", "b"]
+
+
+def test_hinted_cluster_is_picked():
+    probe = stub_probe({
+        "idle": {"ingestion": 0.0, "databases": 0},
+        "tagged": {"ingestion": 0.99, "databases": 500},
+    })
+    placement = placer({"idle": None, "tagged": None}, probe=probe)
+    assert placement.place(hint="tagged").name == "tagged"
+    assert probe.calls == []
+
+
+def test_unknown_hint_is_rejected():
+    placement = placer({"a": {"ingestion": 0.0, "databases": 0}})
+    with pytest.raises(ValueError):
+        placement.place(hint="b")
+
+
+def test_unreachable_cluster_is_skipped_and_probed_again():
+    probe = stub_probe({
+        "down": ConnectionError("unreachable"),
+        "up": {"ingestion": 0.8, "databases": 100},
+    })
+    placement = placer({"down": None, "up": None}, probe=probe)
+    assert placement.place().name == "up"
+    assert placement.place().name == "up"
+    # the failed probe is not cached, the cached one is
+    assert probe.calls == ["down", "up", "down"]
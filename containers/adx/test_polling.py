@@ -0,0 +1,51 @@
+import importlib.util
+import pathlib
+
+import pytest
+from prometheus_client import REGISTRY
+from prometheus_client.metrics import MetricWrapperBase
+
+spec = importlib.util.spec_from_file_location("adx_polling", pathlib.Path(__file__).with_name("main.py"))
+adx = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(adx)
+# every controller registers the same metric names, free them for the tests of the others
+for value in list(vars(adx).values()):
+    if isinstance(value, MetricWrapperBase):
+        REGISTRY.unregister(value)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(adx.time, "monotonic", lambda: now[0])
+    return now
+
+
+def scheduler() -> adx.PollScheduler:
+    return adx.PollScheduler(rate=20, initial=0.5, factor=2, maximum=30)
+
+
+def test_backoff_grows_up_to_maximum(clock):
+    pace = scheduler()
+    delays = []
+    for attempt in range(8):
+        delays.append(pace.delay(attempt))
+        clock[0] += delays[-1]
+    assert delays == [0.5, 1, 2, 4, 8, 16, 30, 30]
+
+
+def test_long_backoff_does_not_delay_new_operations(clock):
+    pace = scheduler()
+    assert pace.delay(10) == 30
+    assert pace.delay(0, retry_after=60) == 60
+    # a new operation still polls fast at first
+    assert pace.delay(0) == 0.5
+
+
+def test_polls_due_together_are_spread(clock):
+    pace = scheduler()
+    delays = [pace.delay(0) for _ in range(3)]
+    assert delays == pytest.approx([0.5, 0.55, 0.6])
+    # a later reservation leaves the gap before it to the polls due earlier
+    assert pace.delay(0, retry_after=0.9) == pytest.approx(0.9)
+    assert pace.delay(0, retry_after=0.62) == pytest.approx(0.65)
@@ -1,78 +1,917 @@
+import bisect
+import functools
+import collections
+import concurrent.futures
+import copy
+import hashlib
+import json
 import os
 import sys
+import threading
+import time
+import urllib.parse
 from kubernetes import client, config, watch
 from azure.identity import ClientSecretCredential
+from azure.core.polling.base_polling import get_retry_after
+from azure.mgmt.core.polling.arm_polling import ARMPolling
 from azure.mgmt.eventhub import EventHubManagementClient
+from azure.mgmt.eventhub.models import ConsumerGroup, EHNamespace, Eventhub, Sku
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.mgmt.resource import ResourceManagementClient
+from azure.mgmt.resource.resources.models import Deployment, DeploymentMode, DeploymentProperties
 from kubernetes.client.rest import ApiException
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 
 
-def get_azure_token(scope: str = "default") -> str:
-    """Returns an azure token"""
-    credentials = ClientSecretCredential(
+@functools.lru_cache(maxsize=None)
+def get_credential() -> ClientSecretCredential:
+    """Returns the azure credential shared by the whole process"""
+    return ClientSecretCredential(
         client_id=os.environ.get("CLIENT_ID"),
         tenant_id=os.environ.get("TENANT_ID"),
         client_secret=os.environ.get("CLIENT_SECRET"),
     )
+
+
+def get_azure_token(scope: str = "default") -> str:
+    """Returns an azure token"""
     scope = os.environ.get("API_SCOPE")
     try:
-        token = credentials.get_token(scope)
+        token = get_credential().get_token(scope)
         return token.token
     except Exception:
         pass
 
 
-def delete_obj(orga_id: str, work_key: str):
-    resource_group_name = os.environ.get("RESOURCE_GROUP_NAME")
-    namespace_name = f"{orga_id}-{work_key}"
-    eventhub_client = EventHubManagementClient(
-        credential=ClientSecretCredential(
-            client_id=os.environ.get("CLIENT_ID"),
-            tenant_id=os.environ.get("TENANT_ID"),
-            client_secret=os.environ.get("CLIENT_SECRET"),
-        ),
+@functools.lru_cache(maxsize=None)
+def get_eventhub_client() -> EventHubManagementClient:
+    return EventHubManagementClient(
+        credential=get_credential(),
+        subscription_id=os.environ.get("AZURE_SUBSCRIPTION"),
+        base_url=os.environ.get("ARM_ENDPOINT"),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_resource_client() -> ResourceManagementClient:
+    return ResourceManagementClient(
+        credential=get_credential(),
         subscription_id=os.environ.get("AZURE_SUBSCRIPTION"),
+        base_url=os.environ.get("ARM_ENDPOINT"),
+    )
+
+
+LRO_SECONDS = Histogram(
+    "triskell_lro_seconds", "Polling time of Azure long running operations", ["operation"]
+)
+LRO_POLLS = Counter(
+    "triskell_lro_polls_total", "Status requests of Azure long running operations", ["operation"]
+)
+
+
+class PollScheduler:
+    """Paces the status requests of every long running operation of the process
+
+    The delay before a poll starts at LRO_POLL_INITIAL seconds and grows by LRO_POLL_FACTOR up to
+    LRO_POLL_MAX, never shorter than Retry-After, and polls are spread to at most ARM_POLL_RATE per second.
+    """
+
+    def __init__(self, rate: float, initial: float, factor: float, maximum: float):
+        self.interval = 1 / rate
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        # due times of the polls already scheduled, sorted
+        self._slots = []
+        self._lock = threading.Lock()
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+        """Seconds to wait before the poll number attempt, counted from 0
+
+        The poll takes the first free slot from its own due time, the backoff of the other operations
+        only matters when their polls fall within ARM_POLL_RATE of it.
+        """
+        delay = max(min(self.initial * self.factor**attempt, self.maximum), retry_after or 0)
+        with self._lock:
+            now = time.monotonic()
+            del self._slots[:bisect.bisect_right(self._slots, now - self.interval)]
+            slot = now + delay
+            for reserved in self._slots[bisect.bisect_right(self._slots, slot - self.interval):]:
+                if reserved >= slot + self.interval:
+                    break
+                slot = reserved + self.interval
+            bisect.insort(self._slots, slot)
+            return slot - now
+
+
+@functools.lru_cache(maxsize=None)
+def get_poll_scheduler() -> PollScheduler:
+    return PollScheduler(
+        rate=float(os.environ.get("ARM_POLL_RATE", "20")),
+        initial=float(os.environ.get("LRO_POLL_INITIAL", "0.5")),
+        factor=float(os.environ.get("LRO_POLL_FACTOR", "2")),
+        maximum=float(os.environ.get("LRO_POLL_MAX", "30")),
+    )
+
+
+def operation_type(request) -> str:
+    """Method and resource type of the request starting an operation, e.g. PUT Microsoft.Kusto/clusters/databases"""
+    path = urllib.parse.urlparse(request.url).path.split("/providers/")[-1].split("/")
+    return f"{request.method} {'/'.join(path[:1] + path[1::2])}"
+
+
+class AdaptiveARMPolling(ARMPolling):
+    """ARM polling paced by the shared PollScheduler, one instance per operation"""
+
+    def next_delay(self) -> float:
+        self._attempt = getattr(self, "_attempt", -1) + 1
+        LRO_POLLS.labels(self.operation).inc()
+        return get_poll_scheduler().delay(self._attempt, get_retry_after(self._pipeline_response))
+
+    @property
+    def operation(self) -> str:
+        return operation_type(self._initial_response.http_response.request)
+
+    def _delay(self):
+        self._sleep(self.next_delay())
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            super().run()
+        finally:
+            LRO_SECONDS.labels(self.operation).observe(time.monotonic() - start)
+
+
+def delete_obj(custom_resource: dict, continuation_token: str = None):
+    """Starts deleting the namespace of spec.id, returns the poller"""
+    resource_group_name = os.environ.get("RESOURCE_GROUP_NAME")
+    eventhub_client = get_eventhub_client()
+    return eventhub_client.namespaces.begin_delete(
+        polling=AdaptiveARMPolling(),
+        resource_group_name=resource_group_name,
+        namespace_name=custom_resource["spec"]["id"],
+        continuation_token=continuation_token,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Bounds the eventhub and consumer group calls in flight to EVENTHUB_CONCURRENCY"""
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=int(os.environ.get("EVENTHUB_CONCURRENCY", "8")), thread_name_prefix="eventhub"
     )
-    eventhub_client.namespaces.begin_delete(
-        resource_group_name=resource_group_name, namespace_name=namespace_name
+
+
+def wait_all(futures: list) -> list:
+    """Results of the futures, raising the first error once they are all done"""
+    concurrent.futures.wait(futures)
+    return [future.result() for future in futures]
+
+
+def same_hub(current, desired: dict) -> bool:
+    return all(getattr(current, key, None) == value for key, value in desired.items())
+
+
+def namespace_parameters(resource_data: dict, tags: dict) -> dict:
+    """Namespace settings of spec.sku {name, tier, capacity} and spec.autoInflate {enabled, maximumThroughputUnits}"""
+    sku = resource_data.get("sku") or {}
+    auto_inflate = resource_data.get("autoInflate") or {}
+    params = {
+        "sku": {"name": sku.get("name", "Standard"), "tier": sku.get("tier", sku.get("name", "Standard"))},
+        "location": os.environ.get("LOCATION"),
+        "tags": {**tags, **(resource_data.get("tags") or {})},
+        "is_auto_inflate_enabled": bool(auto_inflate.get("enabled", False)),
+    }
+    if "capacity" in sku:
+        params["sku"]["capacity"] = int(sku["capacity"])
+    if params["is_auto_inflate_enabled"]:
+        params["maximum_throughput_units"] = int(auto_inflate.get("maximumThroughputUnits", 20))
+    return params
+
+
+def reconcile_namespace(eventhub_client, namespace_name: str, params: dict):
+    """Creates the namespace, or updates it when its sku, throughput units or tags differ from params"""
+    resource_group_name = os.environ.get("RESOURCE_GROUP_NAME")
+    try:
+        current = eventhub_client.namespaces.get(resource_group_name, namespace_name)
+    except ResourceNotFoundError:
+        current = None
+    if current is not None:
+        tags = current.tags or {}
+        if (
+            all(getattr(current.sku, k, None) == v for k, v in params["sku"].items())
+            and all(tags.get(k) == v for k, v in params["tags"].items())
+            and all(
+                getattr(current, k, None) == params.get(k)
+                for k in ("is_auto_inflate_enabled", "maximum_throughput_units")
+                if k in params
+            )
+        ):
+            return
+        # tags set outside of the controller are kept
+        params = {**params, "tags": {**tags, **params["tags"]}}
+        print(f"Update namespace {namespace_name}")
+    eventhub_client.namespaces.begin_create_or_update(
+        polling=AdaptiveARMPolling(),
+        resource_group_name=resource_group_name,
+        namespace_name=namespace_name,
+        parameters=EHNamespace(**{**params, "sku": Sku(**params["sku"])}),
     ).result()
 
 
-def get_org_id_by_name(organization_name: str):
-    api_instance = client.CustomObjectsApi()
-    group = "api.cosmotech.com"  # Update to the correct API group
-    version = "v1"  # Update to the correct API version
-    namespace = os.environ.get("NAMESPACE")  # Assuming custom resource is in default namespace
-    plural = "organizations"
+def hub_parameters(consumers: list) -> dict:
+    """Settings of every eventhub, from the partitionCount and retentionInDays of its spec.consumers entries"""
+    hubs = {}
+    for ev in consumers:
+        hub = hubs.setdefault(
+            ev.get("entity"), {"message_retention_in_days": 4, "partition_count": 4, "status": "Active"}
+        )
+        if "partitionCount" in ev:
+            hub["partition_count"] = int(ev["partitionCount"])
+        if "retentionInDays" in ev:
+            hub["message_retention_in_days"] = int(ev["retentionInDays"])
+    return hubs
+
+
+def keep_partitions(namespace_name: str, hubs: dict, desired_hubs: dict, tier: str):
+    """Keeps the current partition count of the hubs where Azure cannot change it"""
+    for name, params in desired_hubs.items():
+        current = getattr(hubs.get(name), "partition_count", None)
+        # partitions can only be added, and only on premium and dedicated namespaces
+        if current and current != params["partition_count"]:
+            if tier not in ("Premium", "Dedicated") or params["partition_count"] < current:
+                print(f"{namespace_name}/{name}: partition count stays {current} on a {tier} namespace")
+                params["partition_count"] = current
+
+
+def reconcile_hubs(eventhub_client, namespace_name: str, consumers: list, tier: str = "Standard"):
+    """Lists the hubs of the namespace and their consumer groups once, then creates or updates only what differs"""
+    resource_group_name = os.environ.get("RESOURCE_GROUP_NAME")
+    executor = get_executor()
+    desired_hubs = hub_parameters(consumers)
+    desired_groups = {(ev.get("entity"), ev.get("displayName")) for ev in consumers}
+    hubs = {
+        hub.name: hub
+        for hub in eventhub_client.event_hubs.list_by_namespace(resource_group_name, namespace_name)
+    }
+    keep_partitions(namespace_name, hubs, desired_hubs, tier)
+
+    def put_hub(eventhub_name: str):
+        eventhub = eventhub_client.event_hubs.create_or_update(
+            resource_group_name=resource_group_name,
+            namespace_name=namespace_name,
+            event_hub_name=eventhub_name,
+            parameters=Eventhub(**desired_hubs[eventhub_name]),
+        )
+        print("Create EventHub: {}".format(eventhub))
+
+    def list_groups(eventhub_name: str) -> list:
+        return [
+            (eventhub_name, group.name)
+            for group in eventhub_client.consumer_groups.list_by_event_hub(
+                resource_group_name, namespace_name, eventhub_name
+            )
+        ]
+
+    def put_group(eventhub_name: str, consumer_group_name: str):
+        consumer_group = eventhub_client.consumer_groups.create_or_update(
+            resource_group_name=resource_group_name,
+            namespace_name=namespace_name,
+            event_hub_name=eventhub_name,
+            consumer_group_name=consumer_group_name,
+            parameters=ConsumerGroup(user_metadata="New consumergroup"),
+        )
+        print("Create consumer group:\n{}".format(consumer_group))
+
+    changed = [
+        name
+        for name, params in desired_hubs.items()
+        if name not in hubs or not same_hub(hubs[name], params)
+    ]
+    existing = [name for name in desired_hubs if name in hubs]
+    results = wait_all(
+        [executor.submit(put_hub, name) for name in changed]
+        + [executor.submit(list_groups, name) for name in existing]
+    )
+    present = {group for result in results if result for group in result}
+    missing = [group for group in desired_groups if group not in present]
+    # a hub has to exist before its consumer groups
+    wait_all([executor.submit(put_group, *group) for group in missing])
+    print(f"{namespace_name}: {len(changed)} eventhubs and {len(missing)} consumer groups created or updated")
+
+
+EVENTHUB_API_VERSION = "2024-01-01"
+
+
+def render_template(namespace_name: str, params: dict, desired_hubs: dict, desired_groups: set) -> dict:
+    """ARM template of the namespace with its hubs and consumer groups"""
+    namespace_id = f"[resourceId('Microsoft.EventHub/namespaces', '{namespace_name}')]"
+    properties = {"isAutoInflateEnabled": params["is_auto_inflate_enabled"]}
+    if "maximum_throughput_units" in params:
+        properties["maximumThroughputUnits"] = params["maximum_throughput_units"]
+    resources = [
+        {
+            "type": "Microsoft.EventHub/namespaces",
+            "apiVersion": EVENTHUB_API_VERSION,
+            "name": namespace_name,
+            "location": params["location"],
+            "sku": params["sku"],
+            "tags": params["tags"],
+            "properties": properties,
+        }
+    ]
+    for name, hub in desired_hubs.items():
+        resources.append(
+            {
+                "type": "Microsoft.EventHub/namespaces/eventhubs",
+                "apiVersion": EVENTHUB_API_VERSION,
+                "name": f"{namespace_name}/{name}",
+                "dependsOn": [namespace_id],
+                "properties": {
+                    "partitionCount": hub["partition_count"],
+                    "messageRetentionInDays": hub["message_retention_in_days"],
+                    "status": hub["status"],
+                },
+            }
+        )
+    for hub, name in sorted(desired_groups):
+        resources.append(
+            {
+                "type": "Microsoft.EventHub/namespaces/eventhubs/consumergroups",
+                "apiVersion": EVENTHUB_API_VERSION,
+                "name": f"{namespace_name}/{hub}/{name}",
+                "dependsOn": [
+                    f"[resourceId('Microsoft.EventHub/namespaces/eventhubs', '{namespace_name}', '{hub}')]"
+                ],
+                "properties": {"userMetadata": "New consumergroup"},
+            }
+        )
+    return {
+        "$schema": "https://schema.management.azure.com/schemas/2019-04-01/deploymentTemplate.json#",
+        "contentVersion": "1.0.0.0",
+        "resources": resources,
+    }
+
+
+class DeploymentFailed(Exception):
+    def __init__(self, status: dict):
+        super().__init__(status["deployment"].get("error"))
+        self.status = status
+
+
+def deploy_template(eventhub_client, namespace_name: str, params: dict, consumers: list) -> dict:
+    """Applies the namespace, hubs and consumer groups as one incremental ARM deployment, returns status fields"""
+    resource_group_name = os.environ.get("RESOURCE_GROUP_NAME")
+    try:
+        current = eventhub_client.namespaces.get(resource_group_name, namespace_name)
+    except ResourceNotFoundError:
+        hubs = {}
+    else:
+        # a deployment replaces the tags, the ones set outside of the controller are kept
+        params = {**params, "tags": {**(current.tags or {}), **params["tags"]}}
+        hubs = {
+            hub.name: hub
+            for hub in eventhub_client.event_hubs.list_by_namespace(resource_group_name, namespace_name)
+        }
+    desired_hubs = hub_parameters(consumers)
+    keep_partitions(namespace_name, hubs, desired_hubs, params["sku"]["tier"])
+    desired_groups = {(ev.get("entity"), ev.get("displayName")) for ev in consumers}
+    deployment_name = f"eventhub-{namespace_name}"[:64]
+    resource_client = get_resource_client()
+    deployment = {"name": deployment_name, "state": "Succeeded"}
     try:
-        api_response = api_instance.get_namespaced_custom_object(
-            group=group,
-            namespace=namespace,
-            name=organization_name,
-            plural=plural,
-            version=version,
+        resource_client.deployments.begin_create_or_update(
+            polling=AdaptiveARMPolling(),
+            resource_group_name=resource_group_name,
+            deployment_name=deployment_name,
+            parameters=Deployment(
+                properties=DeploymentProperties(
+                    mode=DeploymentMode.INCREMENTAL,
+                    template=render_template(namespace_name, params, desired_hubs, desired_groups),
+                )
+            ),
+        ).result()
+    except HttpResponseError as e:
+        deployment.update(state="Failed", error=str(e))
+    deployment["resources"] = []
+    for operation in resource_client.deployment_operations.list(resource_group_name, deployment_name):
+        target = operation.properties.target_resource
+        if target is None:
+            continue
+        outcome = {
+            "type": target.resource_type,
+            "name": target.resource_name,
+            "state": operation.properties.provisioning_state,
+        }
+        if operation.properties.provisioning_state == "Failed":
+            outcome["message"] = str(operation.properties.status_message)
+        deployment["resources"].append(outcome)
+    print(f"Deployment {deployment_name}: {deployment['state']}")
+    if deployment["state"] != "Succeeded":
+        raise DeploymentFailed({"deployment": deployment})
+    return {"deployment": deployment}
+
+
+def provision(eventhub_client, namespace_name: str, resource_data: dict, tags: dict) -> dict:
+    """Applies the namespace, hubs and consumer groups of the spec, returns status fields
+
+    EVENTHUB_DEPLOYMENT=template sends them as one ARM deployment instead of one call per resource.
+    """
+    params = namespace_parameters(resource_data, tags)
+    if os.environ.get("EVENTHUB_DEPLOYMENT", "direct") == "template":
+        return deploy_template(eventhub_client, namespace_name, params, resource_data.get("consumers") or [])
+    reconcile_namespace(eventhub_client, namespace_name, params)
+    reconcile_hubs(eventhub_client, namespace_name, resource_data.get("consumers") or [], params["sku"]["tier"])
+    return {}
+
+
+CACHE_LOOKUPS = Counter(
+    "triskell_cr_cache_lookups_total",
+    "Custom resource lookups served by the informer cache",
+    ["plural", "result"],
+)
+
+
+class CRInformer:
+    """In-memory copy of api.cosmotech.com custom resources, fed by list+watch and indexed by name"""
+
+    def __init__(self, plural: str):
+        self.plural = plural
+        self.hits = 0
+        self.misses = 0
+        self._items = {}
+        self._lock = threading.Lock()
+        self._synced = threading.Event()
+        threading.Thread(target=self._run, name=f"informer-{plural}", daemon=True).start()
+
+    def _relist(self, api_instance, namespace: str) -> str:
+        response = api_instance.list_namespaced_custom_object(
+            "api.cosmotech.com", "v1", namespace, self.plural
         )
+        with self._lock:
+            self._items = {
+                item["metadata"]["name"]: item for item in response.get("items", [])
+            }
+        self._synced.set()
+        return response["metadata"]["resourceVersion"]
+
+    def _run(self):
+        api_instance = client.CustomObjectsApi()
+        namespace = os.environ.get("NAMESPACE")
+        resource_version = ""
+        while True:
+            try:
+                if not resource_version:
+                    resource_version = self._relist(api_instance, namespace)
+                stream = watch.Watch().stream(
+                    api_instance.list_namespaced_custom_object,
+                    "api.cosmotech.com",
+                    "v1",
+                    namespace,
+                    self.plural,
+                    resource_version=resource_version,
+                )
+                for event in stream:
+                    if not event:
+                        continue
+                    obj = event["object"]
+                    with self._lock:
+                        if event["type"] == "DELETED":
+                            self._items.pop(obj["metadata"]["name"], None)
+                        else:
+                            self._items[obj["metadata"]["name"]] = obj
+                    resource_version = obj["metadata"]["resourceVersion"]
+            except ApiException as e:
+                if e.status == 410:
+                    # resourceVersion too old, start again from a fresh list
+                    resource_version = ""
+                else:
+                    print("Exception in %s informer: %s\n" % (self.plural, e))
+                    time.sleep(1)
+            except Exception as e:
+                print("Exception in %s informer: %s\n" % (self.plural, e))
+                time.sleep(1)
+
+    def get(self, name: str):
+        self._synced.wait(timeout=10)
+        with self._lock:
+            obj = self._items.get(name)
+            if obj is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if obj is not None:
+            CACHE_LOOKUPS.labels(self.plural, "hit").inc()
+            return obj
+        CACHE_LOOKUPS.labels(self.plural, "miss").inc()
+        # not seen by the watch yet, ask the API server directly
+        try:
+            obj = client.CustomObjectsApi().get_namespaced_custom_object(
+                group="api.cosmotech.com",
+                namespace=os.environ.get("NAMESPACE"),
+                name=name,
+                plural=self.plural,
+                version="v1",
+            )
+        except Exception as e:
+            print("Exception: %s\n" % e)
+            return None
+        with self._lock:
+            return self._items.setdefault(name, obj)
+
+
+INFORMERS = {}
+INFORMERS_LOCK = threading.Lock()
+
+
+def get_informer(plural: str) -> CRInformer:
+    with INFORMERS_LOCK:
+        if plural not in INFORMERS:
+            INFORMERS[plural] = CRInformer(plural=plural)
+        return INFORMERS[plural]
+
+
+def get_org_id_by_name(organization_name: str):
+    api_response = get_informer("organizations").get(organization_name)
+    if api_response:
         return api_response.get("spec").get("id")
-    except Exception as e:
-        print("Exception: %s\n" % e)
 
 
 def get_work_key_by_name(workspace_name: str):
-    api_instance = client.CustomObjectsApi()
-    group = "api.cosmotech.com"  # Update to the correct API group
-    version = "v1"  # Update to the correct API version
-    namespace = os.environ.get("NAMESPACE")  # Assuming custom resource is in default namespace
-    plural = "workspaces"
+    api_response = get_informer("workspaces").get(workspace_name)
+    if api_response:
+        return api_response.get("spec").get("key")
+
+
+class WorkQueue:
+    """Hands watch events to a pool of workers, keeping the events of one resource in order"""
+
+    def __init__(self, handler, workers: int = 0):
+        self.handler = handler
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._ready = collections.deque()
+        self._busy = set()
+        for i in range(workers or int(os.environ.get("WORKERS", "4"))):
+            threading.Thread(target=self._work, name=f"worker-{i}", daemon=True).start()
+
+    def add(self, key: str, event: dict):
+        with self._cond:
+            # a key already pending or being reconciled is picked up again by its worker
+            if key not in self._pending and key not in self._busy:
+                self._ready.append(key)
+                self._cond.notify()
+            self._pending.setdefault(key, []).append(event)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                key = self._ready.popleft()
+                events = self._pending.pop(key)
+                self._busy.add(key)
+            for event in events:
+                try:
+                    self.handler(event)
+                except Exception as e:
+                    print("Exception when reconciling %s: %s\n" % (key, e))
+            with self._cond:
+                self._busy.discard(key)
+                if key in self._pending:
+                    self._ready.append(key)
+                    self._cond.notify()
+
+
+FINALIZER = "azure.cosmotech.com/eventhub"
+LRO_IN_FLIGHT = Gauge("triskell_lro_in_flight", "Long running operations followed by the tracker")
+
+
+class LroTracker:
+    """Follows long running operations from one thread and calls back once each one is done"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._operations = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, name="lro-tracker", daemon=True).start()
+
+    def tracking(self, key: str) -> bool:
+        with self._lock:
+            return key in self._operations
+
+    def track(self, key: str, poller, done, failed):
+        with self._lock:
+            self._operations[key] = (poller, done, failed)
+            LRO_IN_FLIGHT.set(len(self._operations))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                finished = {k: op for k, op in self._operations.items() if op[0].done()}
+                for key in finished:
+                    del self._operations[key]
+                LRO_IN_FLIGHT.set(len(self._operations))
+            for key, (poller, done, failed) in finished.items():
+                try:
+                    poller.result()
+                except Exception as e:
+                    print(f"Operation {key} failed: {e}")
+                    callback = functools.partial(failed, e)
+                else:
+                    callback = done
+                try:
+                    callback()
+                except Exception as e:
+                    print("Exception when completing %s: %s\n" % (key, e))
+
+
+@functools.lru_cache(maxsize=None)
+def get_lro_tracker() -> LroTracker:
+    return LroTracker(interval=float(os.environ.get("LRO_TRACK_INTERVAL", "1")))
+
+
+def set_finalizer(api_instance, group: str, version: str, namespace: str, plural: str, name: str, present: bool):
+    """Adds or removes the finalizer of the controller, leaving the other finalizers alone"""
     try:
-        api_response = api_instance.get_namespaced_custom_object(
-            group=group,
-            namespace=namespace,
-            name=workspace_name,
-            plural=plural,
-            version=version,
+        current = api_instance.get_namespaced_custom_object(group, version, namespace, plural, name)
+    except ApiException as e:
+        if e.status == 404:
+            return
+        raise
+    finalizers = [f for f in current["metadata"].get("finalizers") or [] if f != FINALIZER]
+    if present:
+        finalizers.append(FINALIZER)
+    api_instance.patch_namespaced_custom_object(
+        group,
+        version,
+        namespace,
+        plural,
+        name,
+        # the resource version makes a concurrent change of the finalizers fail instead of being lost
+        {"metadata": {"finalizers": finalizers, "resourceVersion": current["metadata"]["resourceVersion"]}},
+    )
+
+
+DELETE_RETRIES = {}
+DELETE_RETRIES_LOCK = threading.Lock()
+
+
+def retry_delete(api_instance, group: str, version: str, namespace: str, plural: str, name: str, retry_at: float):
+    """Starts the delete of the resource again at retry_at, one pending retry per resource"""
+
+    def retry():
+        with DELETE_RETRIES_LOCK:
+            DELETE_RETRIES.pop(name, None)
+        try:
+            current = api_instance.get_namespaced_custom_object(group, version, namespace, plural, name)
+            if "deletionTimestamp" in current["metadata"]:
+                start_delete(api_instance, group, version, namespace, plural, current)
+        except ApiException as e:
+            if e.status != 404:
+                print("Exception when retrying delete of %s: %s\n" % (name, e))
+        except Exception as e:
+            print("Exception when retrying delete of %s: %s\n" % (name, e))
+
+    with DELETE_RETRIES_LOCK:
+        if name in DELETE_RETRIES:
+            return
+        timer = threading.Timer(max(retry_at - time.time(), 0), retry)
+        timer.daemon = True
+        DELETE_RETRIES[name] = timer
+    timer.start()
+
+
+def start_delete(api_instance, group: str, version: str, namespace: str, plural: str, custom_resource: dict):
+    """Starts deleting the azure resource, or resumes from the poller token kept in the status
+
+    The finalizer is removed by the tracker once the delete is done. A failed delete clears the token and
+    records the error, the attempts and the time of the next attempt, DELETE_RETRY_INITIAL seconds doubled
+    on every failure up to DELETE_RETRY_MAX; events until then do not start it again.
+    """
+    name = custom_resource["metadata"]["name"]
+    status = custom_resource.get("status") or {}
+    if get_lro_tracker().tracking(name):
+        return
+    if not custom_resource["spec"].get("id"):
+        # nothing was provisioned
+        set_finalizer(api_instance, group, version, namespace, plural, name, False)
+        return
+    deletion = status.get("deletion") or {}
+    if deletion.get("retryAt") and deletion["retryAt"] > time.time():
+        # the previous attempt failed, the MODIFIED event of its status does not start it again
+        retry_delete(api_instance, group, version, namespace, plural, name, deletion["retryAt"])
+        return
+
+    def failed(e: Exception):
+        attempts = int(deletion.get("attempts", 0)) + 1
+        delay = min(
+            float(os.environ.get("DELETE_RETRY_INITIAL", "30")) * 2 ** (attempts - 1),
+            float(os.environ.get("DELETE_RETRY_MAX", "900")),
         )
-        return api_response.get("spec").get("key")
+        print(f"Delete of {name} failed {attempts} time(s), next attempt in {delay:.0f}s: {e}")
+        api_instance.patch_namespaced_custom_object_status(
+            group,
+            version,
+            namespace,
+            plural,
+            name,
+            {
+                "status": {
+                    "deletion": {
+                        "state": "Failed",
+                        "token": None,
+                        "error": str(e),
+                        "attempts": attempts,
+                        "retryAt": time.time() + delay,
+                    }
+                }
+            },
+        )
+        retry_delete(api_instance, group, version, namespace, plural, name, time.time() + delay)
+
+    token = deletion.get("token")
+    try:
+        poller = delete_obj(custom_resource, continuation_token=token)
     except Exception as e:
-        print("Exception: %s\n" % e)
+        failed(e)
+        return
+    if not token:
+        api_instance.patch_namespaced_custom_object_status(
+            group,
+            version,
+            namespace,
+            plural,
+            name,
+            {"status": {"deletion": {"state": "Deleting", "token": poller.continuation_token()}}},
+        )
+
+    def done():
+        print(f"Deleted {custom_resource['spec']['id']}")
+        set_finalizer(api_instance, group, version, namespace, plural, name, False)
+
+    get_lro_tracker().track(name, poller, done, failed)
+
+
+def spec_hash(spec: dict) -> str:
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# generation and spec hash applied by this process, the status patch may not be visible yet
+APPLIED = {}
+
+
+def is_reconciled(custom_resource: dict) -> bool:
+    """True when this generation and spec were already applied, according to the status or to this process"""
+    status = custom_resource.get("status") or {}
+    current = (
+        custom_resource["metadata"].get("generation"),
+        spec_hash(custom_resource.get("spec", {})),
+    )
+    return current in (
+        (status.get("observedGeneration"), status.get("specHash")),
+        APPLIED.get(custom_resource["metadata"].get("uid")),
+    )
+
+
+def record_applied(
+    api_instance, group: str, version: str, namespace: str, plural: str, custom_resource: dict, status: dict = None
+):
+    """Stores the generation and spec hash just applied, plus any extra status fields, in the status subresource"""
+    APPLIED[custom_resource["metadata"].get("uid")] = (
+        custom_resource["metadata"].get("generation"),
+        spec_hash(custom_resource.get("spec", {})),
+    )
+    try:
+        api_instance.patch_namespaced_custom_object_status(
+            group,
+            version,
+            namespace,
+            plural,
+            custom_resource["metadata"]["name"],
+            {
+                "status": {
+                    "observedGeneration": custom_resource["metadata"].get("generation"),
+                    "specHash": spec_hash(custom_resource.get("spec", {})),
+                    **(status or {}),
+                }
+            },
+        )
+    except ApiException as e:
+        print("Exception when calling patch status: %s\n" % e)
+
+
+def record_failure(api_instance, group: str, version: str, namespace: str, plural: str, name: str, status: dict):
+    """Stores the outcome of a failed provisioning in the status subresource, leaving it to be retried"""
+    try:
+        api_instance.patch_namespaced_custom_object_status(group, version, namespace, plural, name, {"status": status})
+    except ApiException as e:
+        print("Exception when calling patch status: %s\n" % e)
+
+
+def reconcile(event: dict):
+    api_instance = client.CustomObjectsApi()
+    group = "azure.cosmotech.com"  # Update to the correct API group
+    version = "v1"  # Update to the correct API version
+    namespace = os.environ.get("NAMESPACE")  # Assuming custom resource is in default namespace
+    plural = "eventhubs"
+    eventhub_client = get_eventhub_client()
+    custom_resource = event["object"]
+    event_type = event["type"]
+    if event_type in ("ADDED", "MODIFIED"):
+        if "deletionTimestamp" in custom_resource["metadata"]:
+            if FINALIZER in (custom_resource["metadata"].get("finalizers") or []):
+                start_delete(api_instance, group, version, namespace, plural, custom_resource)
+            return
+        if FINALIZER not in (custom_resource["metadata"].get("finalizers") or []):
+            set_finalizer(api_instance, group, version, namespace, plural, custom_resource["metadata"]["name"], True)
+    if event_type in ("ADDED", "MODIFIED") and is_reconciled(custom_resource):
+        # already applied by a previous run of the controller
+        return
+    # Extract custom resource name
+    resource_name = custom_resource["metadata"]["name"]
+    organization_name = (
+        custom_resource["spec"].get("selector", {}).get("organization", "")
+    )
+    workspace_name = (
+        custom_resource["spec"].get("selector", {}).get("workspace", "")
+    )
+    # Extract key-value pairs from the custom resource spec
+    resource_data = custom_resource.get("spec", {})
+    # Handle events of type MODIFIED (settings changed): scale and hubs are applied again
+    if event_type == "MODIFIED":
+        if not resource_data.get("id"):
+            # not provisioned yet, the ADDED event takes care of it
+            return
+        try:
+            status = provision(eventhub_client, resource_data["id"], resource_data, {})
+        except DeploymentFailed as e:
+            record_failure(api_instance, group, version, namespace, plural, resource_name, e.status)
+            raise
+        record_applied(api_instance, group, version, namespace, plural, custom_resource, status)
+    # Handle events of type ADDED (resource created)
+    elif event_type == "ADDED":
+        orga_id = get_org_id_by_name(organization_name=organization_name)
+        work_key = get_work_key_by_name(workspace_name=workspace_name)
+        if orga_id and work_key:
+            namespace_name = f"{orga_id}-{work_key}"
+            try:
+                status = provision(
+                    eventhub_client, namespace_name, resource_data, {"organization": orga_id, "workspace": work_key}
+                )
+            except DeploymentFailed as e:
+                record_failure(api_instance, group, version, namespace, plural, resource_name, e.status)
+                raise
+
+            try:
+                del resource_data["selector"]
+                custom_resource["spec"]["id"] = namespace_name
+                # the spec only, metadata has moved on with the finalizer
+                api_response = api_instance.patch_namespaced_custom_object(
+                    group,
+                    version,
+                    namespace,
+                    plural,
+                    resource_name,
+                    {"spec": custom_resource["spec"]},
+                )
+                record_applied(api_instance, group, version, namespace, plural, api_response, status)
+                print(api_response)
+            except ApiException as e:
+                print("Exception when calling patch: %s\n" % e)
+    # Handle events of type DELETED (resource deleted)
+    # the finalizer has been removed by the tracker, only resources that never got it are left to delete
+    elif event_type == "DELETED" and resource_data.get("id") and "deletion" not in (custom_resource.get("status") or {}):
+        delete_obj(custom_resource)
+
+
+WATCH_RECONNECTS = Counter(
+    "triskell_watch_reconnects_total", "Watch streams reopened", ["plural"]
+)
+RELIST_SECONDS = Histogram(
+    "triskell_watch_relist_seconds", "Duration of full relists", ["plural"]
+)
+
+
+def relist(api_instance, group: str, version: str, namespace: str, plural: str, known: dict, work_queue) -> str:
+    """Lists the custom resources and queues only the ones that changed since they were last seen"""
+    start = time.monotonic()
+    response = api_instance.list_namespaced_custom_object(group, version, namespace, plural)
+    items = {item["metadata"]["name"]: item for item in response.get("items", [])}
+    previous = dict(known)
+    known.clear()
+    known.update({name: copy.deepcopy(item) for name, item in items.items()})
+    for name, item in items.items():
+        if name not in previous:
+            work_queue.add(name, {"type": "ADDED", "object": item})
+        elif previous[name]["metadata"]["resourceVersion"] != item["metadata"]["resourceVersion"]:
+            work_queue.add(name, {"type": "MODIFIED", "object": item})
+    for name in set(previous) - set(items):
+        work_queue.add(name, {"type": "DELETED", "object": previous[name]})
+    RELIST_SECONDS.labels(plural).observe(time.monotonic() - start)
+    return response["metadata"]["resourceVersion"]
 
 
 def main():
@@ -81,106 +920,52 @@ def main():
     version = "v1"  # Update to the correct API version
     namespace = os.environ.get("NAMESPACE")  # Assuming custom resource is in default namespace
     plural = "eventhubs"
+    work_queue = WorkQueue(handler=reconcile)
     # Watch for events on custom resource
+    known = {}
     resource_version = ""
-    credential = ClientSecretCredential(
-        client_id=os.environ.get("CLIENT_ID"),
-        tenant_id=os.environ.get("TENANT_ID"),
-        client_secret=os.environ.get("CLIENT_SECRET"),
-    )
-    eventhub_client = EventHubManagementClient(
-        credential=credential,
-        subscription_id=os.environ.get("AZURE_SUBSCRIPTION"),
-    )
     while True:
-        stream = watch.Watch().stream(
-            api_instance.list_namespaced_custom_object,
-            group,
-            version,
-            namespace,
-            plural,
-            resource_version=resource_version,
-        )
-        for event in stream:
-            custom_resource = event["object"]
-            event_type = event["type"]
-            # Extract custom resource name
-            resource_name = custom_resource["metadata"]["name"]
-            organization_name = (
-                custom_resource["spec"].get("selector", {}).get("organization", "")
-            )
-            workspace_name = (
-                custom_resource["spec"].get("selector", {}).get("workspace", "")
+        try:
+            if not resource_version:
+                resource_version = relist(
+                    api_instance, group, version, namespace, plural, known, work_queue
+                )
+            stream = watch.Watch().stream(
+                api_instance.list_namespaced_custom_object,
+                group,
+                version,
+                namespace,
+                plural,
+                resource_version=resource_version,
+                allow_watch_bookmarks=True,
+                timeout_seconds=int(os.environ.get("WATCH_TIMEOUT_SECONDS", "300")),
             )
-            # Extract key-value pairs from the custom resource spec
-            resource_data = custom_resource.get("spec", {})
-            # Handle events of type ADDED (resource created)
-            if event_type == "ADDED":
-                orga_id = get_org_id_by_name(organization_name=organization_name)
-                work_key = get_work_key_by_name(workspace_name=workspace_name)
-                if orga_id and work_key:
-                    resource_group_name = os.environ.get("RESOURCE_GROUP_NAME")
-                    namespace_name = f"{orga_id}-{work_key}"
-                    location = os.environ.get("LOCATION")
-                    # Create Namespace
-                    eventhub_client.namespaces.begin_create_or_update(
-                        resource_group_name=resource_group_name,
-                        namespace_name=namespace_name,
-                        parameters={
-                            "sku": {"name": "Standard", "tier": "Standard"},
-                            "location": location,
-                            "tags": {"tag1": "value1", "tag2": "value2"},
-                        },
-                    ).result()
-
-                    # Create EventHubs
-                    for ev in resource_data.get("consumers"):
-                        eventhub_name = ev.get("entity")
-                        eventhub = eventhub_client.event_hubs.create_or_update(
-                            resource_group_name=resource_group_name,
-                            namespace_name=namespace_name,
-                            event_hub_name=eventhub_name,
-                            parameters={
-                                "message_retention_in_days": "4",
-                                "partition_count": "4",
-                                "status": "Active",
-                            },
-                        )
-                        print("Create EventHub: {}".format(eventhub))
-                        # Create Consumer Group
-                        consumer_group_name = ev.get("displayName")
-                        consumer_group = (
-                            eventhub_client.consumer_groups.create_or_update(
-                                resource_group_name=resource_group_name,
-                                namespace_name=namespace_name,
-                                event_hub_name=eventhub_name,
-                                consumer_group_name=consumer_group_name,
-                                parameters={"user_metadata": "New consumergroup"},
-                            )
-                        )
-                        print("Create consumer group:\n{}".format(consumer_group))
-
-                    try:
-                        del resource_data["selector"]
-                        custom_resource["spec"]["id"] = namespace_name
-                        api_response = api_instance.patch_namespaced_custom_object(
-                            group,
-                            version,
-                            namespace,
-                            plural,
-                            resource_name,
-                            custom_resource,
-                        )
-                        print(api_response)
-                    except ApiException as e:
-                        print("Exception when calling patch: %s\n" % e)
-            # Handle events of type DELETED (resource deleted)
-            elif event_type == "DELETED":
-                orga_id = get_org_id_by_name(organization_name=organization_name)
-                work_key = get_work_key_by_name(workspace_name=workspace_name)
-                delete_obj(orga_id=orga_id, work_key=work_key)
-            # Update resource_version to resume watching from the last event
-            resource_version = custom_resource["metadata"]["resourceVersion"]
+            for event in stream:
+                if not event:
+                    continue
+                custom_resource = event["object"]
+                # Update resource_version to resume watching from the last event
+                resource_version = custom_resource["metadata"]["resourceVersion"]
+                if event["type"] == "BOOKMARK":
+                    continue
+                resource_name = custom_resource["metadata"]["name"]
+                if event["type"] == "DELETED":
+                    known.pop(resource_name, None)
+                else:
+                    known[resource_name] = copy.deepcopy(custom_resource)
+                work_queue.add(resource_name, event)
+        except ApiException as e:
+            if e.status == 410:
+                # resourceVersion expired, relist and queue only what changed
+                resource_version = ""
+            else:
+                print("Exception when watching %s: %s\n" % (plural, e))
+                time.sleep(1)
+        except Exception as e:
+            # dropped connections and undecodable events, resume from the last resourceVersion seen
+            print("Exception when watching %s: %s\n" % (plural, e))
+            time.sleep(1)
+        WATCH_RECONNECTS.labels(plural).inc()
 
 
 def check_env():
@@ -204,4 +989,5 @@ def check_env():
 if __name__ == "__main__":
     check_env()
     config.load_incluster_config()  # Use in-cluster configuration
+    start_http_server(int(os.environ.get("METRICS_PORT", "8000")))
     main()
@@ -0,0 +1,174 @@
+import http.server
+import importlib.util
+import json
+import pathlib
+import threading
+import urllib.parse
+
+import pytest
+from prometheus_client import REGISTRY
+from prometheus_client.metrics import MetricWrapperBase
+from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.policies import SansIOHTTPPolicy
+
+try:
+    from azure.mgmt.resource import ResourceManagementClient
+    from azure.mgmt.resource.resources.models import Deployment  # noqa: F401
+except ImportError:
+    # the deployments client is gone from azure-mgmt-resource 24+, the Dockerfile pins <24
+    pytest.skip("needs azure-mgmt-resource<24, as installed by the Dockerfile", allow_module_level=True)
+
+spec = importlib.util.spec_from_file_location("eventhub_main", pathlib.Path(__file__).with_name("main.py"))
+eventhub = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(eventhub)
+# every controller registers the same metric names, free them for the tests of the others
+for value in list(vars(eventhub).values()):
+    if isinstance(value, MetricWrapperBase):
+        REGISTRY.unregister(value)
+
+DEPLOYMENT = "/subscriptions/sub/resourcegroups/rg/providers/Microsoft.Resources/deployments/eventhub-o-1-w-1"
+
+
+class FakeArm(http.server.BaseHTTPRequestHandler):
+    """Deployments endpoint of ARM: the PUT is accepted, then reported running once and succeeded"""
+
+    requests = []
+    polls = 0
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def deployment(self, state: str) -> dict:
+        return {"id": DEPLOYMENT, "name": "eventhub-o-1-w-1", "properties": {"provisioningState": state}}
+
+    def do_PUT(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        FakeArm.requests.append(("PUT", self.path, body))
+        operation = f"http://{self.headers['Host']}/operations/1"
+        self.reply(201, self.deployment("Accepted"), {"Azure-AsyncOperation": operation, "Retry-After": "0"})
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        FakeArm.requests.append(("GET", path, None))
+        if path == "/operations/1":
+            FakeArm.polls += 1
+            self.reply(200, {"status": "Running" if FakeArm.polls == 1 else "Succeeded"}, {"Retry-After": "0"})
+        elif path.lower() == DEPLOYMENT.lower():
+            self.reply(200, self.deployment("Succeeded"))
+        elif path.lower().endswith("/deployments/eventhub-o-1-w-1/operations"):
+            target = {
+                "resourceType": "Microsoft.EventHub/namespaces/eventhubs",
+                "resourceName": "o-1-w-1/probes",
+            }
+            self.reply(200, {"value": [
+                {"operationId": "1", "properties": {"provisioningState": "Succeeded", "targetResource": target}},
+                {"operationId": "2", "properties": {"provisioningState": "Succeeded"}},
+            ]})
+        else:
+            self.reply(404, {"error": {"code": "NotFound", "message": path}})
+
+
+class Credential:
+    def get_token(self, *scopes, **kwargs):
+        raise AssertionError("no token is requested from the fake endpoint")
+
+
+class Namespaces:
+    def get(self, resource_group_name, namespace_name):
+        raise ResourceNotFoundError("not found")
+
+
+class EventHubClient:
+    namespaces = Namespaces()
+
+
+@pytest.fixture
+def arm(monkeypatch):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeArm)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    FakeArm.requests = []
+    FakeArm.polls = 0
+    resource_client = ResourceManagementClient(
+        credential=Credential(),
+        subscription_id="sub",
+        base_url=f"http://127.0.0.1:{server.server_port}",
+        # no bearer token over plain http
+        authentication_policy=SansIOHTTPPolicy(),
+    )
+    monkeypatch.setattr(eventhub, "get_resource_client", lambda: resource_client)
+    monkeypatch.setenv("RESOURCE_GROUP_NAME", "rg")
+    monkeypatch.setenv("LOCATION", "westeurope")
+    monkeypatch.setenv("LRO_POLL_INITIAL", "0.01")
+    eventhub.get_poll_scheduler.cache_clear()
+    yield FakeArm
+    server.shutdown()
+    eventhub.get_poll_scheduler.cache_clear()
+
+
+CONSUMERS = [
+    {"entity": "probes", "displayName": "adx", "partitionCount": 2},
+    {"entity": "probes", "displayName": "stream"},
+    {"entity": "scenarios", "displayName": "adx", "retentionInDays": 7},
+]
+
+
+def test_rendered_template():
+    params = eventhub.namespace_parameters({"sku": {"name": "Standard", "capacity": 2}}, {"organization": "o-1"})
+    template = eventhub.render_template(
+        "o-1-w-1", params, eventhub.hub_parameters(CONSUMERS), {(c["entity"], c["displayName"]) for c in CONSUMERS}
+    )
+    namespace, *children = template["resources"]
+    assert namespace["type"] == "Microsoft.EventHub/namespaces"
+    assert namespace["sku"] == {"name": "Standard", "tier": "Standard", "capacity": 2}
+    assert namespace["tags"] == {"organization": "o-1"}
+    assert [(r["type"].split("/")[-1], r["name"]) for r in children] == [
+        ("eventhubs", "o-1-w-1/probes"),
+        ("eventhubs", "o-1-w-1/scenarios"),
+        ("consumergroups", "o-1-w-1/probes/adx"),
+        ("consumergroups", "o-1-w-1/probes/stream"),
+        ("consumergroups", "o-1-w-1/scenarios/adx"),
+    ]
+    assert children[0]["properties"]["partitionCount"] == 2
+    assert children[1]["properties"]["messageRetentionInDays"] == 7
+    assert children[2]["dependsOn"] == [
+        "[resourceId('Microsoft.EventHub/namespaces/eventhubs', 'o-1-w-1', 'probes')]"
+    ]
+
+
+def test_one_deployment_put_then_polls(arm):
+    params = eventhub.namespace_parameters({}, {"organization": "o-1"})
+    status = eventhub.deploy_template(EventHubClient(), "o-1-w-1", params, CONSUMERS)
+
+    puts = [r for r in arm.requests if r[0] == "PUT"]
+    assert len(puts) == 1
+    method, path, body = puts[0]
+    assert urllib.parse.urlparse(path).path.lower() == DEPLOYMENT.lower()
+    assert body["properties"]["mode"] == "Incremental"
+    assert body["properties"]["template"] == eventhub.render_template(
+        "o-1-w-1",
+        params,
+        eventhub.hub_parameters(CONSUMERS),
+        {(c["entity"], c["displayName"]) for c in CONSUMERS},
+    )
+    # polled until succeeded, nothing else is written
+    assert arm.polls == 2
+    assert [r[1] for r in arm.requests if r[0] == "GET"][:2] == ["/operations/1", "/operations/1"]
+    assert status == {
+        "deployment": {
+            "name": "eventhub-o-1-w-1",
+            "state": "Succeeded",
+            "resources": [
+                {"type": "Microsoft.EventHub/namespaces/eventhubs", "name": "o-1-w-1/probes", "state": "Succeeded"}
+            ],
+        }
+    }
@@ -1,11 +1,25 @@
+import base64
+import collections
+import concurrent.futures
+import copy
+import functools
+import hashlib
+import io
+import json
 import os
 from pathlib import Path
+import resource
 import sys
-import polling2
 import pathlib
+import threading
+import time
+import urllib.parse
+from uuid import uuid4
 from kubernetes import client, config, watch
 from kubernetes.client.rest import ApiException
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 import requests
+from requests.adapters import HTTPAdapter
 
 
 def update_credentials(workspace_id: str, dataset_id: str):
@@ -99,86 +113,360 @@ def add_user(workspace_id: str, user: dict):
         print(e)
 
 
+UPLOAD_BYTES = Counter("triskell_powerbi_upload_bytes_total", "Bytes of .pbix files uploaded", ["method"])
+UPLOAD_SECONDS = Histogram(
+    "triskell_powerbi_upload_seconds",
+    "Duration of .pbix uploads",
+    ["method"],
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1200),
+)
+PEAK_RSS = Gauge("triskell_powerbi_peak_rss_bytes", "Peak resident memory of the controller")
+
+
+class MultipartFile:
+    """multipart/form-data body of one file, read in chunks so the file is never held in memory"""
+
+    def __init__(self, path: Path, field: str = "file", chunk_size: int = 1 << 20):
+        self.boundary = uuid4().hex
+        self.chunk_size = chunk_size
+        head = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{path.name}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self._length = len(head) + path.stat().st_size + len(tail)
+        self._file = open(path, "rb")
+        self._parts = collections.deque([io.BytesIO(head), self._file, io.BytesIO(tail)])
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        size = self._length if size is None or size < 0 else size
+        data = b""
+        while self._parts and len(data) < size:
+            chunk = self._parts[0].read(size - len(data))
+            if not chunk:
+                self._parts.popleft()
+            data += chunk
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), b"")
+
+    def close(self):
+        self._file.close()
+
+
+def upload_to_temporary_location(session: requests.Session, workspace_id: str, pbix_file: Path, token: str) -> str:
+    """Puts the file block by block in a temporary upload location of the workspace, returns its url"""
+    response = session.post(
+        url=f"https://api.powerbi.com/v1.0/myorg/groups/{workspace_id}/imports/createTemporaryUploadLocation",
+        headers={"Content-Type": "application/json", "Authorization": f"Bearer {token}"},
+    )
+    response.raise_for_status()
+    url = response.json().get("url")
+    chunk_size = int(os.environ.get("PBIX_UPLOAD_CHUNK_MB", "8")) << 20
+    block_ids = []
+    with open(pbix_file, "rb") as _f:
+        for chunk in iter(lambda: _f.read(chunk_size), b""):
+            block_id = base64.b64encode(f"{len(block_ids):08d}".encode()).decode()
+            session.put(
+                url=f"{url}&comp=block&blockid={urllib.parse.quote(block_id)}", data=chunk
+            ).raise_for_status()
+            block_ids.append(block_id)
+    block_list = "".join(f"<Latest>{block_id}</Latest>" for block_id in block_ids)
+    session.put(
+        url=f"{url}&comp=blocklist",
+        data=f'<?xml version="1.0" encoding="utf-8"?><BlockList>{block_list}</BlockList>',
+        headers={"Content-Type": "application/xml"},
+    ).raise_for_status()
+    return url
+
+
 def upload(workspace_id: str, pbix_file: Path, name: str):
+    """Imports the file, streamed as multipart up to PBIX_DIRECT_IMPORT_LIMIT_MB, through a temporary location above"""
     token = os.environ.get("TOKEN")
-    header = {
-        "Content-Type": "multipart/form-data",
-        "Authorization": f"Bearer {token}",
-    }
     route = (
         f"https://api.powerbi.com/v1.0/myorg/groups/{workspace_id}"
         f"/imports?datasetDisplayName={name}&nameConflict=CreateOrOverwrite"
     )
     session = requests.Session()
     import_data = {}
-    output_data = {}
     if pbix_file.exists():
-        with open(pbix_file, "rb") as _f:
-            response = session.post(url=route, headers=header, files={"file": _f})
+        size = pbix_file.stat().st_size
+        method = "multipart"
+        start = time.monotonic()
+        if size > int(os.environ.get("PBIX_DIRECT_IMPORT_LIMIT_MB", "1024")) << 20:
+            method = "blob"
+            file_url = upload_to_temporary_location(session, workspace_id, pbix_file, token)
+            response = session.post(
+                url=route,
+                headers={"Content-Type": "application/json", "Authorization": f"Bearer {token}"},
+                json={"fileUrl": file_url},
+            )
+        else:
+            body = MultipartFile(pbix_file)
+            try:
+                response = session.post(
+                    url=route,
+                    headers={"Content-Type": body.content_type, "Authorization": f"Bearer {token}"},
+                    data=body,
+                )
+            finally:
+                body.close()
+        elapsed = time.monotonic() - start
+        UPLOAD_BYTES.labels(method).inc(size)
+        UPLOAD_SECONDS.labels(method).observe(elapsed)
+        # ru_maxrss is in kilobytes on linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        PEAK_RSS.set(peak_rss)
+        print(
+            f"[powerbi] uploaded {pbix_file.name} ({size >> 20} MB, {method}) "
+            f"at {size / max(elapsed, 1e-3) / (1 << 20):.1f} MB/s, peak RSS {peak_rss >> 20} MB"
+        )
+        response.raise_for_status()
+        import_data = response.json()
+    return import_data
+
+
+@functools.lru_cache(maxsize=None)
+def get_session() -> requests.Session:
+    """Keep-alive session shared by the import tracker"""
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(os.environ.get("POWERBI_POOL_SIZE", "10")))
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
+IMPORTS_IN_FLIGHT = Gauge("triskell_powerbi_imports_in_flight", "PowerBI imports being tracked")
+IMPORT_SECONDS = Histogram(
+    "triskell_powerbi_import_seconds",
+    "Time from upload to the end of PowerBI imports",
+    ["state"],
+    buckets=(5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600),
+)
+
+
+class ImportTracker:
+    """Polls every outstanding PowerBI import from one thread, backing off per import until its deadline
+
+    done(import_data) or failed(reason) run on a small pool of threads once an import is over.
+    """
+
+    def __init__(self, initial: float, factor: float, maximum: float, deadline: float):
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.deadline = deadline
+        self._imports = {}
+        self._cond = threading.Condition()
+        self._callbacks = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="import")
+        threading.Thread(target=self._run, name="import-tracker", daemon=True).start()
+
+    def track(self, workspace_id: str, import_id: str, started: float, done, failed):
+        """started is the epoch time of the upload, so that the deadline holds across restarts"""
+        with self._cond:
+            if import_id in self._imports:
+                return
+            self._imports[import_id] = {
+                "workspace_id": workspace_id,
+                "started": started,
+                "attempt": 0,
+                "next": time.monotonic() + self.initial,
+                "done": done,
+                "failed": failed,
+            }
+            IMPORTS_IN_FLIGHT.set(len(self._imports))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                due = [(k, entry) for k, entry in self._imports.items() if entry["next"] <= now]
+                if not due:
+                    wake = min((entry["next"] for entry in self._imports.values()), default=now + 60)
+                    self._cond.wait(wake - now)
+                    continue
+            for import_id, entry in due:
+                self._poll(import_id, entry)
+
+    def _poll(self, import_id: str, entry: dict):
+        url = f"https://api.powerbi.com/v1.0/myorg/groups/{entry['workspace_id']}/imports/{import_id}"
+        import_data = {}
+        try:
+            response = get_session().get(
+                url=url,
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {os.environ.get('TOKEN')}",
+                },
+                timeout=30,
+            )
+            response.raise_for_status()
             import_data = response.json()
-            route_ = f"https://api.powerbi.com/v1.0/myorg/groups/{workspace_id}/imports/{import_data.get('id')}"
-            handler = polling2.poll(
-                lambda: requests.get(
-                    url=route_,
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {token}",
-                    },
-                ),
-                check_success=is_correct_response_app,
-                step=1,
-                timeout=60,
+        except Exception as e:
+            print(f"[powerbi] cannot get import {import_id}: {e}")
+        state = import_data.get("importState")
+        elapsed = time.time() - entry["started"]
+        if state == "Succeeded":
+            callback = functools.partial(entry["done"], import_data)
+        elif state == "Failed":
+            callback = functools.partial(entry["failed"], json.dumps(import_data.get("error", state)))
+        elif elapsed > self.deadline:
+            state = "TimedOut"
+            callback = functools.partial(entry["failed"], f"not imported after {int(elapsed)}s")
+        else:
+            entry["attempt"] += 1
+            entry["next"] = time.monotonic() + min(self.initial * self.factor ** entry["attempt"], self.maximum)
+            return
+        with self._cond:
+            del self._imports[import_id]
+            IMPORTS_IN_FLIGHT.set(len(self._imports))
+        IMPORT_SECONDS.labels(state).observe(elapsed)
+        print(f"[powerbi] import {import_id}: {state}")
+        self._callbacks.submit(self._call, import_id, callback)
+
+    @staticmethod
+    def _call(import_id: str, callback):
+        try:
+            callback()
+        except Exception as e:
+            print(f"[powerbi] exception when completing import {import_id}: {e}")
+
+
+@functools.lru_cache(maxsize=None)
+def get_import_tracker() -> ImportTracker:
+    return ImportTracker(
+        initial=float(os.environ.get("PBIX_IMPORT_POLL_INITIAL", "1")),
+        factor=float(os.environ.get("PBIX_IMPORT_POLL_FACTOR", "1.5")),
+        maximum=float(os.environ.get("PBIX_IMPORT_POLL_MAX", "30")),
+        deadline=float(os.environ.get("PBIX_IMPORT_DEADLINE_SECONDS", "1800")),
+    )
+
+
+CACHE_LOOKUPS = Counter(
+    "triskell_cr_cache_lookups_total",
+    "Custom resource lookups served by the informer cache",
+    ["plural", "result"],
+)
+
+
+class CRInformer:
+    """In-memory copy of api.cosmotech.com custom resources, fed by list+watch and indexed by name"""
+
+    def __init__(self, plural: str):
+        self.plural = plural
+        self.hits = 0
+        self.misses = 0
+        self._items = {}
+        self._lock = threading.Lock()
+        self._synced = threading.Event()
+        threading.Thread(target=self._run, name=f"informer-{plural}", daemon=True).start()
+
+    def _relist(self, api_instance, namespace: str) -> str:
+        response = api_instance.list_namespaced_custom_object(
+            "api.cosmotech.com", "v1", namespace, self.plural
+        )
+        with self._lock:
+            self._items = {
+                item["metadata"]["name"]: item for item in response.get("items", [])
+            }
+        self._synced.set()
+        return response["metadata"]["resourceVersion"]
+
+    def _run(self):
+        api_instance = client.CustomObjectsApi()
+        namespace = os.environ.get("NAMESPACE")
+        resource_version = ""
+        while True:
+            try:
+                if not resource_version:
+                    resource_version = self._relist(api_instance, namespace)
+                stream = watch.Watch().stream(
+                    api_instance.list_namespaced_custom_object,
+                    "api.cosmotech.com",
+                    "v1",
+                    namespace,
+                    self.plural,
+                    resource_version=resource_version,
+                )
+                for event in stream:
+                    if not event:
+                        continue
+                    obj = event["object"]
+                    with self._lock:
+                        if event["type"] == "DELETED":
+                            self._items.pop(obj["metadata"]["name"], None)
+                        else:
+                            self._items[obj["metadata"]["name"]] = obj
+                    resource_version = obj["metadata"]["resourceVersion"]
+            except ApiException as e:
+                if e.status == 410:
+                    # resourceVersion too old, start again from a fresh list
+                    resource_version = ""
+                else:
+                    print("Exception in %s informer: %s\n" % (self.plural, e))
+                    time.sleep(1)
+            except Exception as e:
+                print("Exception in %s informer: %s\n" % (self.plural, e))
+                time.sleep(1)
+
+    def get(self, name: str):
+        self._synced.wait(timeout=10)
+        with self._lock:
+            obj = self._items.get(name)
+            if obj is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if obj is not None:
+            CACHE_LOOKUPS.labels(self.plural, "hit").inc()
+            return obj
+        CACHE_LOOKUPS.labels(self.plural, "miss").inc()
+        # not seen by the watch yet, ask the API server directly
+        try:
+            obj = client.CustomObjectsApi().get_namespaced_custom_object(
+                group="api.cosmotech.com",
+                namespace=os.environ.get("NAMESPACE"),
+                name=name,
+                plural=self.plural,
+                version="v1",
             )
-            output_data = handler.json()
-    return output_data
+        except Exception as e:
+            print("Exception: %s\n" % e)
+            return None
+        with self._lock:
+            return self._items.setdefault(name, obj)
 
 
-def is_correct_response_app(response):
-    output_data = response.json()
-    if output_data.get("importState") == "Succeeded":
-        return output_data
+INFORMERS = {}
+INFORMERS_LOCK = threading.Lock()
+
+
+def get_informer(plural: str) -> CRInformer:
+    with INFORMERS_LOCK:
+        if plural not in INFORMERS:
+            INFORMERS[plural] = CRInformer(plural=plural)
+        return INFORMERS[plural]
 
 
 def get_org_id_by_name(organization_name: str):
-    api_instance = client.CustomObjectsApi()
-    group = "api.cosmotech.com"  # Update to the correct API group
-    version = "v1"  # Update to the correct API version
-    namespace = os.environ.get(
-        "NAMESPACE"
-    )  # Assuming custom resource is in default namespace
-    plural = "organizations"
-    try:
-        api_response = api_instance.get_namespaced_custom_object(
-            group=group,
-            namespace=namespace,
-            name=organization_name,
-            plural=plural,
-            version=version,
-        )
+    api_response = get_informer("organizations").get(organization_name)
+    if api_response:
         return api_response.get("spec").get("id")
-    except Exception as e:
-        print("Exception: %s\n" % e)
 
 
 def get_work_id_by_name(workspace_name: str):
-    api_instance = client.CustomObjectsApi()
-    group = "api.cosmotech.com"  # Update to the correct API group
-    version = "v1"  # Update to the correct API version
-    namespace = os.environ.get(
-        "NAMESPACE"
-    )  # Assuming custom resource is in default namespace
-    plural = "workspaces"
-    try:
-        api_response = api_instance.get_namespaced_custom_object(
-            group=group,
-            namespace=namespace,
-            name=workspace_name,
-            plural=plural,
-            version=version,
-        )
+    api_response = get_informer("workspaces").get(workspace_name)
+    if api_response:
         return api_response.get("spec").get("id")
-    except Exception as e:
-        print("Exception: %s\n" % e)
 
 
 def get_by_name_or_id(name: str, workspace_id: str = ""):
@@ -239,7 +527,182 @@ def delete_dataset(workspace_id: str, dataset_id: str):
         print(e)
 
 
-def main():
+class WorkQueue:
+    """Hands watch events to a pool of workers, keeping the events of one resource in order"""
+
+    def __init__(self, handler, workers: int = 0):
+        self.handler = handler
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._ready = collections.deque()
+        self._busy = set()
+        for i in range(workers or int(os.environ.get("WORKERS", "4"))):
+            threading.Thread(target=self._work, name=f"worker-{i}", daemon=True).start()
+
+    def add(self, key: str, event: dict):
+        with self._cond:
+            # a key already pending or being reconciled is picked up again by its worker
+            if key not in self._pending and key not in self._busy:
+                self._ready.append(key)
+                self._cond.notify()
+            self._pending.setdefault(key, []).append(event)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                key = self._ready.popleft()
+                events = self._pending.pop(key)
+                self._busy.add(key)
+            for event in events:
+                try:
+                    self.handler(event)
+                except Exception as e:
+                    print("Exception when reconciling %s: %s\n" % (key, e))
+            with self._cond:
+                self._busy.discard(key)
+                if key in self._pending:
+                    self._ready.append(key)
+                    self._cond.notify()
+
+
+def spec_hash(spec: dict) -> str:
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def is_reconciled(custom_resource: dict) -> bool:
+    """True when the status records this generation and spec as already applied"""
+    status = custom_resource.get("status") or {}
+    return status.get("observedGeneration") == custom_resource["metadata"].get(
+        "generation"
+    ) and status.get("specHash") == spec_hash(custom_resource.get("spec", {}))
+
+
+def record_applied(
+    api_instance, group: str, version: str, namespace: str, plural: str, custom_resource: dict, status: dict = None
+):
+    """Stores the generation and spec hash just applied, plus any extra status fields, in the status subresource"""
+    try:
+        api_instance.patch_namespaced_custom_object_status(
+            group,
+            version,
+            namespace,
+            plural,
+            custom_resource["metadata"]["name"],
+            {
+                "status": {
+                    "observedGeneration": custom_resource["metadata"].get("generation"),
+                    "specHash": spec_hash(custom_resource.get("spec", {})),
+                    **(status or {}),
+                }
+            },
+        )
+    except ApiException as e:
+        print("Exception when calling patch status: %s\n" % e)
+
+
+CONTENT_HASHES = {}
+CONTENT_HASHES_LOCK = threading.Lock()
+
+
+def content_hash(pbix_file: Path) -> str:
+    """sha256 of the file read in chunks, computed again only when its path, mtime or size change"""
+    stat = pbix_file.stat()
+    key = (str(pbix_file), stat.st_mtime_ns, stat.st_size)
+    with CONTENT_HASHES_LOCK:
+        if key in CONTENT_HASHES:
+            return CONTENT_HASHES[key]
+    digest = hashlib.sha256()
+    with open(pbix_file, "rb") as _f:
+        for chunk in iter(lambda: _f.read(1 << 20), b""):
+            digest.update(chunk)
+    with CONTENT_HASHES_LOCK:
+        # older versions of the file are not asked for again
+        for stale in [k for k in CONTENT_HASHES if k[0] == key[0]]:
+            del CONTENT_HASHES[stale]
+        CONTENT_HASHES[key] = digest.hexdigest()
+        return CONTENT_HASHES[key]
+
+
+def content_changed(content: dict, digest: str, resource_data: dict) -> bool:
+    """True when the file at spec.path, or the workspace and name it goes to, differ from the last import"""
+    return (
+        content.get("hash") != digest
+        or content.get("workspaceId") != resource_data.get("workspaceId")
+        or content.get("name") != resource_data.get("name")
+    )
+
+
+def record_import(api_instance, group: str, version: str, namespace: str, plural: str, name: str, pending: dict):
+    try:
+        api_instance.patch_namespaced_custom_object_status(
+            group, version, namespace, plural, name, {"status": {"import": pending}}
+        )
+    except ApiException as e:
+        print("Exception when calling patch status: %s\n" % e)
+
+
+def track_import(
+    api_instance, group: str, version: str, namespace: str, plural: str, name: str, resource_data: dict, pending: dict
+):
+    """Hands the import to the tracker, which sets the parameters, credentials and report id once it is done"""
+    workspace_id = resource_data.get("workspaceId")
+
+    def done(report_obj: dict):
+        spec = {}
+        for d in report_obj.get("datasets", []):
+            update_param(
+                workspace_id=workspace_id,
+                dataset_id=d.get("id"),
+                params=resource_data.get("parameters", []),
+            )
+            update_credentials(
+                workspace_id=workspace_id,
+                dataset_id=d.get("id"),
+            )
+            spec["datasetId"] = d.get("id")
+        spec["id"] = report_obj.get("reports")[0].get("id")
+        link = "https://app.powerbi.com/"
+        link += f"groups/{workspace_id}/"
+        link += f"reports/{spec['id']}/"
+        link += "ReportSection?experience=power-bi"
+        spec["link"] = link
+        try:
+            api_response = api_instance.patch_namespaced_custom_object(
+                group, version, namespace, plural, name, {"spec": spec}
+            )
+            record_applied(
+                api_instance,
+                group,
+                version,
+                namespace,
+                plural,
+                api_response,
+                {
+                    "import": {**pending, "state": "Succeeded"},
+                    "content": {
+                        "hash": pending.get("hash"),
+                        "workspaceId": workspace_id,
+                        "name": resource_data.get("name"),
+                        "parametersHash": spec_hash(resource_data.get("parameters", [])),
+                        "datasetId": spec.get("datasetId"),
+                        "reportId": spec["id"],
+                    },
+                },
+            )
+        except ApiException as e:
+            print("Exception when calling patch: %s\n" % e)
+
+    def failed(reason: str):
+        record_import(
+            api_instance, group, version, namespace, plural, name, {**pending, "state": "Failed", "reason": reason}
+        )
+
+    get_import_tracker().track(workspace_id, pending["id"], pending.get("started", time.time()), done, failed)
+
+
+def reconcile(event: dict):
     api_instance = client.CustomObjectsApi()
     group = "powerbi.cosmotech.com"  # Update to the correct API group
     version = "v1"  # Update to the correct API version
@@ -247,74 +710,149 @@ def main():
         "NAMESPACE"
     )  # Assuming custom resource is in default namespace
     plural = "reports"
+    custom_resource = event["object"]
+    event_type = event["type"]
+    # Extract custom resource name
+    resource_name = custom_resource["metadata"]["name"]
+    # Extract key-value pairs from the custom resource spec
+    resource_data = custom_resource.get("spec", {})
+    # Handle events of type ADDED (resource created)
+    if event_type == "ADDED":
+        workspace_id = resource_data.get("workspaceId")
+        status = custom_resource.get("status") or {}
+        content = status.get("content") or {}
+        pbix_file = pathlib.Path(resource_data.get("path"))
+        digest = content_hash(pbix_file) if pbix_file.exists() else ""
+        if is_reconciled(custom_resource) and not (digest and content_changed(content, digest, resource_data)):
+            # already applied by a previous run of the controller, and the file has not changed since
+            return
+        pending = status.get("import") or {}
+        if pending.get("state") == "Publishing":
+            # uploaded before a restart, only the import is left to follow
+            track_import(api_instance, group, version, namespace, plural, resource_name, resource_data, pending)
+            return
+        if digest and not content_changed(content, digest, resource_data) and content.get("reportId"):
+            # the same file is already imported, only new parameters are left to apply
+            parameters_hash = spec_hash(resource_data.get("parameters", []))
+            if content.get("parametersHash") != parameters_hash:
+                update_param(
+                    workspace_id=workspace_id,
+                    dataset_id=content.get("datasetId"),
+                    params=resource_data.get("parameters", []),
+                )
+            print(f"[powerbi] {pbix_file.name} unchanged, not imported again")
+            record_applied(
+                api_instance,
+                group,
+                version,
+                namespace,
+                plural,
+                custom_resource,
+                {"content": {**content, "parametersHash": parameters_hash}},
+            )
+            return
+        import_data = upload(
+            workspace_id=workspace_id,
+            pbix_file=pbix_file,
+            name=resource_data.get("name"),
+        )
+        if not import_data.get("id"):
+            print(f"[powerbi] {resource_data.get('path')} was not uploaded")
+            return
+        pending = {"id": import_data["id"], "state": "Publishing", "started": time.time(), "hash": digest}
+        record_import(api_instance, group, version, namespace, plural, resource_name, pending)
+        track_import(api_instance, group, version, namespace, plural, resource_name, resource_data, pending)
+    elif event_type == "MODIFIED":
+        pass
+    # Handle events of type DELETED (resource deleted)
+    elif event_type == "DELETED":
+        delete_dataset(
+            workspace_id=resource_data.get("workspaceId"),
+            dataset_id=resource_data.get("datasetId"),
+        )
+
+
+WATCH_RECONNECTS = Counter(
+    "triskell_watch_reconnects_total", "Watch streams reopened", ["plural"]
+)
+RELIST_SECONDS = Histogram(
+    "triskell_watch_relist_seconds", "Duration of full relists", ["plural"]
+)
+
+
+def relist(api_instance, group: str, version: str, namespace: str, plural: str, known: dict, work_queue) -> str:
+    """Lists the custom resources and queues only the ones that changed since they were last seen"""
+    start = time.monotonic()
+    response = api_instance.list_namespaced_custom_object(group, version, namespace, plural)
+    items = {item["metadata"]["name"]: item for item in response.get("items", [])}
+    previous = dict(known)
+    known.clear()
+    known.update({name: copy.deepcopy(item) for name, item in items.items()})
+    for name, item in items.items():
+        if name not in previous:
+            work_queue.add(name, {"type": "ADDED", "object": item})
+        elif previous[name]["metadata"]["resourceVersion"] != item["metadata"]["resourceVersion"]:
+            work_queue.add(name, {"type": "MODIFIED", "object": item})
+    for name in set(previous) - set(items):
+        work_queue.add(name, {"type": "DELETED", "object": previous[name]})
+    RELIST_SECONDS.labels(plural).observe(time.monotonic() - start)
+    return response["metadata"]["resourceVersion"]
+
 
+def main():
+    api_instance = client.CustomObjectsApi()
+    group = "powerbi.cosmotech.com"  # Update to the correct API group
+    version = "v1"  # Update to the correct API version
+    namespace = os.environ.get(
+        "NAMESPACE"
+    )  # Assuming custom resource is in default namespace
+    plural = "reports"
+    work_queue = WorkQueue(handler=reconcile)
     # Watch for events on custom resource
+    known = {}
     resource_version = ""
     while True:
-        stream = watch.Watch().stream(
-            api_instance.list_namespaced_custom_object,
-            group,
-            version,
-            namespace,
-            plural,
-            resource_version=resource_version,
-        )
-        for event in stream:
-            custom_resource = event["object"]
-            event_type = event["type"]
-            # Extract custom resource name
-            resource_name = custom_resource["metadata"]["name"]
-            # Extract key-value pairs from the custom resource spec
-            resource_data = custom_resource.get("spec", {})
-            # Handle events of type ADDED (resource created)
-            if event_type == "ADDED":
-                params = resource_data.get("parameters", [])
-                report_obj = upload(
-                    workspace_id=resource_data.get("workspaceId"),
-                    pbix_file=pathlib.Path(resource_data.get("path")),
-                    name=resource_data.get("name"),
-                )
-                if report_obj:
-                    for d in report_obj.get("datasets", []):
-                        update_param(
-                            workspace_id=resource_data.get("workspaceId"),
-                            dataset_id=d.get("id"),
-                            params=params,
-                        )
-                        update_credentials(
-                            workspace_id=resource_data.get("workspaceId"),
-                            dataset_id=d.get("id"),
-                        )
-                        custom_resource["spec"]["datasetId"] = d.get("id")
-                    custom_resource["spec"]["id"] = report_obj.get("reports")[0].get(
-                        "id"
-                    )
-                    link = "https://app.powerbi.com/"
-                    link += f"groups/{resource_data.get('workspaceId')}/"
-                    link += f"reports/{custom_resource['spec']['id']}/"
-                    link += "ReportSection?experience=power-bi"
-                    custom_resource["spec"]["link"] = link
-                try:
-                    api_instance.patch_namespaced_custom_object(
-                        group,
-                        version,
-                        namespace,
-                        plural,
-                        resource_name,
-                        custom_resource,
-                    )
-                except ApiException as e:
-                    print("Exception when calling patch: %s\n" % e)
-            elif event_type == "MODIFIED":
-                pass
-            # Handle events of type DELETED (resource deleted)
-            elif event_type == "DELETED":
-                delete_dataset(
-                    workspace_id=resource_data.get("workspaceId"),
-                    dataset_id=resource_data.get("datasetId"),
+        try:
+            if not resource_version:
+                resource_version = relist(
+                    api_instance, group, version, namespace, plural, known, work_queue
                 )
-            # Update resource_version to resume watching from the last event
-            resource_version = custom_resource["metadata"]["resourceVersion"]
+            stream = watch.Watch().stream(
+                api_instance.list_namespaced_custom_object,
+                group,
+                version,
+                namespace,
+                plural,
+                resource_version=resource_version,
+                allow_watch_bookmarks=True,
+                timeout_seconds=int(os.environ.get("WATCH_TIMEOUT_SECONDS", "300")),
+            )
+            for event in stream:
+                if not event:
+                    continue
+                custom_resource = event["object"]
+                # Update resource_version to resume watching from the last event
+                resource_version = custom_resource["metadata"]["resourceVersion"]
+                if event["type"] == "BOOKMARK":
+                    continue
+                resource_name = custom_resource["metadata"]["name"]
+                if event["type"] == "DELETED":
+                    known.pop(resource_name, None)
+                else:
+                    known[resource_name] = copy.deepcopy(custom_resource)
+                work_queue.add(resource_name, event)
+        except ApiException as e:
+            if e.status == 410:
+                # resourceVersion expired, relist and queue only what changed
+                resource_version = ""
+            else:
+                print("Exception when watching %s: %s\n" % (plural, e))
+                time.sleep(1)
+        except Exception as e:
+            # dropped connections and undecodable events, resume from the last resourceVersion seen
+            print("Exception when watching %s: %s\n" % (plural, e))
+            time.sleep(1)
+        WATCH_RECONNECTS.labels(plural).inc()
 
 
 def check_env():
@@ -327,4 +865,5 @@ def check_env():
 if __name__ == "__main__":
     check_env()
     config.load_incluster_config()  # Use in-cluster configuration
+    start_http_server(int(os.environ.get("METRICS_PORT", "8000")))
     main()
@@ -1,35 +1,127 @@
 import sys
 import requests
+from requests.adapters import HTTPAdapter
+import functools
+import collections
+import copy
 import os
+import threading
+import time
 from kubernetes import client, config, watch
 from azure.identity import ClientSecretCredential
 from kubernetes.client.rest import ApiException
+from prometheus_client import Counter, Histogram, start_http_server
 
 
-def get_azure_token(scope: str = "default") -> str:
-    """Returns an azure token"""
-    credentials = ClientSecretCredential(
+TOKEN_FETCH_SECONDS = Histogram(
+    "triskell_azure_token_fetch_seconds", "Latency of Azure token requests"
+)
+TOKEN_REFRESHES = Counter(
+    "triskell_azure_token_refresh_total", "Azure tokens fetched from AAD"
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_credential() -> ClientSecretCredential:
+    """Returns the azure credential shared by the whole process"""
+    return ClientSecretCredential(
         client_id=os.environ.get("CLIENT_ID"),
         tenant_id=os.environ.get("TENANT_ID"),
         client_secret=os.environ.get("CLIENT_SECRET"),
     )
-    scope = os.environ.get("API_SCOPE")
+
+
+class TokenCache:
+    """Azure token shared by all reconcilers, refreshed in the background before it expires"""
+
+    def __init__(self, scope: str):
+        self.scope = scope
+        self.refresh_margin = int(os.environ.get("TOKEN_REFRESH_MARGIN", "300"))
+        self._token = None
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def _fetch(self):
+        start = time.monotonic()
+        self._token = get_credential().get_token(self.scope)
+        TOKEN_FETCH_SECONDS.observe(time.monotonic() - start)
+        TOKEN_REFRESHES.inc()
+
+    def _refresh_loop(self):
+        while True:
+            with self._lock:
+                expires_on = self._token.expires_on if self._token else 0
+            time.sleep(max(expires_on - self.refresh_margin - time.time(), 5))
+            try:
+                with self._lock:
+                    self._fetch()
+            except Exception as e:
+                print("Exception when refreshing azure token: %s\n" % e)
+
+    def get(self) -> str:
+        with self._lock:
+            # callers wait on the lock while a single fetch is in flight
+            if self._token is None or self._token.expires_on - time.time() < 60:
+                self._fetch()
+            if self._refresher is None:
+                self._refresher = threading.Thread(
+                    target=self._refresh_loop, name="token-refresh", daemon=True
+                )
+                self._refresher.start()
+            return self._token.token
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_cache(scope: str) -> TokenCache:
+    return TokenCache(scope=scope)
+
+
+def get_azure_token(scope: str = "default") -> str:
+    """Returns an azure token from the process-wide cache"""
     try:
-        token = credentials.get_token(scope)
-        return token.token
+        return get_token_cache(os.environ.get("API_SCOPE")).get()
     except Exception:
         pass
 
 
+class CosmotechApiClient:
+    """Keep-alive session to the Cosmotech API, with pooled connections and timeouts"""
+
+    def __init__(self):
+        self.url = os.environ.get("API_URL")
+        self.timeout = (
+            float(os.environ.get("API_CONNECT_TIMEOUT", "5")),
+            float(os.environ.get("API_READ_TIMEOUT", "60")),
+        )
+        pool_size = int(os.environ.get("API_POOL_SIZE", "10"))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        return self.session.request(
+            method,
+            url=f"{self.url}{path}",
+            headers=get_headers(),
+            timeout=self.timeout,
+            **kwargs,
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def get_api_client() -> CosmotechApiClient:
+    return CosmotechApiClient()
+
+
 def get_by_id(org_id: str, sol_id: str):
     if not sol_id:
         return None
-    headers = get_headers()
-    url = os.environ.get("API_URL")
     try:
-        response = requests.get(
-            url=f"{url}/organizations/{org_id}/solutions/{sol_id}",
-            headers=headers,
+        response = get_api_client().request(
+            "GET",
+            f"/organizations/{org_id}/solutions/{sol_id}",
         )
         if response.status_code == 404:
             return None
@@ -40,24 +132,20 @@ def get_by_id(org_id: str, sol_id: str):
 
 
 def delete_obj(org_id: str, sol_id: str):
-    headers = get_headers()
-    url = os.environ.get("API_URL")
     try:
-        requests.delete(
-            url=f"{url}/organizations/{org_id}/solutions/{sol_id}",
-            headers=headers,
+        get_api_client().request(
+            "DELETE",
+            f"/organizations/{org_id}/solutions/{sol_id}",
         )
     except Exception as e:
         print(e)
 
 
 def update(org_id: str, sol_id: str, data: dict):
-    headers = get_headers()
-    url = os.environ.get("API_URL")
     try:
-        response = requests.patch(
-            url=f"{url}/organizations/{org_id}/solutions/{sol_id}",
-            headers=headers,
+        response = get_api_client().request(
+            "PATCH",
+            f"/organizations/{org_id}/solutions/{sol_id}",
             json=data,
         )
         if response is None:
@@ -68,12 +156,10 @@ def update(org_id: str, sol_id: str, data: dict):
 
 
 def create(org_id: str, data: dict):
-    headers = get_headers()
-    url = os.environ.get("API_URL")
     try:
-        response = requests.post(
-            url=f"{url}/organizations/{org_id}/solutions",
-            headers=headers,
+        response = get_api_client().request(
+            "POST",
+            f"/organizations/{org_id}/solutions",
             json=data,
         )
         if response is None:
@@ -83,23 +169,114 @@ def create(org_id: str, data: dict):
         print(e)
 
 
-def get_org_id_by_name(organization_name: str):
-    api_instance = client.CustomObjectsApi()
-    group = "api.cosmotech.com"  # Update to the correct API group
-    version = "v1"  # Update to the correct API version
-    namespace = os.environ.get("NAMESPACE")  # Assuming custom resource is in default namespace
-    plural = "organizations"
-    try:
-        api_response = api_instance.get_namespaced_custom_object(
-            group=group,
-            namespace=namespace,
-            name=organization_name,
-            plural=plural,
-            version=version,
+CACHE_LOOKUPS = Counter(
+    "triskell_cr_cache_lookups_total",
+    "Custom resource lookups served by the informer cache",
+    ["plural", "result"],
+)
+
+
+class CRInformer:
+    """In-memory copy of api.cosmotech.com custom resources, fed by list+watch and indexed by name"""
+
+    def __init__(self, plural: str):
+        self.plural = plural
+        self.hits = 0
+        self.misses = 0
+        self._items = {}
+        self._lock = threading.Lock()
+        self._synced = threading.Event()
+        threading.Thread(target=self._run, name=f"informer-{plural}", daemon=True).start()
+
+    def _relist(self, api_instance, namespace: str) -> str:
+        response = api_instance.list_namespaced_custom_object(
+            "api.cosmotech.com", "v1", namespace, self.plural
         )
-        return api_response
-    except Exception as e:
-        print("Exception: %s\n" % e)
+        with self._lock:
+            self._items = {
+                item["metadata"]["name"]: item for item in response.get("items", [])
+            }
+        self._synced.set()
+        return response["metadata"]["resourceVersion"]
+
+    def _run(self):
+        api_instance = client.CustomObjectsApi()
+        namespace = os.environ.get("NAMESPACE")
+        resource_version = ""
+        while True:
+            try:
+                if not resource_version:
+                    resource_version = self._relist(api_instance, namespace)
+                stream = watch.Watch().stream(
+                    api_instance.list_namespaced_custom_object,
+                    "api.cosmotech.com",
+                    "v1",
+                    namespace,
+                    self.plural,
+                    resource_version=resource_version,
+                )
+                for event in stream:
+                    if not event:
+                        continue
+                    obj = event["object"]
+                    with self._lock:
+                        if event["type"] == "DELETED":
+                            self._items.pop(obj["metadata"]["name"], None)
+                        else:
+                            self._items[obj["metadata"]["name"]] = obj
+                    resource_version = obj["metadata"]["resourceVersion"]
+            except ApiException as e:
+                if e.status == 410:
+                    # resourceVersion too old, start again from a fresh list
+                    resource_version = ""
+                else:
+                    print("Exception in %s informer: %s\n" % (self.plural, e))
+                    time.sleep(1)
+            except Exception as e:
+                print("Exception in %s informer: %s\n" % (self.plural, e))
+                time.sleep(1)
+
+    def get(self, name: str):
+        self._synced.wait(timeout=10)
+        with self._lock:
+            obj = self._items.get(name)
+            if obj is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if obj is not None:
+            CACHE_LOOKUPS.labels(self.plural, "hit").inc()
+            return obj
+        CACHE_LOOKUPS.labels(self.plural, "miss").inc()
+        # not seen by the watch yet, ask the API server directly
+        try:
+            obj = client.CustomObjectsApi().get_namespaced_custom_object(
+                group="api.cosmotech.com",
+                namespace=os.environ.get("NAMESPACE"),
+                name=name,
+                plural=self.plural,
+                version="v1",
+            )
+        except Exception as e:
+            print("Exception: %s\n" % e)
+            return None
+        with self._lock:
+            return self._items.setdefault(name, obj)
+
+
+INFORMERS = {}
+INFORMERS_LOCK = threading.Lock()
+
+
+def get_informer(plural: str) -> CRInformer:
+    with INFORMERS_LOCK:
+        if plural not in INFORMERS:
+            INFORMERS[plural] = CRInformer(plural=plural)
+        return INFORMERS[plural]
+
+
+def get_org_id_by_name(organization_name: str):
+    return get_informer("organizations").get(organization_name)
 
 
 def get_headers():
@@ -119,91 +296,229 @@ def get_headers():
     return headers
 
 
-def main():
+COALESCED_EVENTS = Counter(
+    "triskell_modified_events_coalesced_total",
+    "MODIFIED events replaced by a later MODIFIED event of the same resource",
+)
+
+
+class WorkQueue:
+    """Hands watch events to a pool of workers, keeping the events of one resource in order"""
+
+    def __init__(self, handler, workers: int = 0):
+        self.handler = handler
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._ready = collections.deque()
+        self._busy = set()
+        self._not_before = {}
+        self.debounce = float(os.environ.get("MODIFIED_DEBOUNCE_SECONDS", "1"))
+        for i in range(workers or int(os.environ.get("WORKERS", "4"))):
+            threading.Thread(target=self._work, name=f"worker-{i}", daemon=True).start()
+
+    def add(self, key: str, event: dict):
+        with self._cond:
+            # a key already pending or being reconciled is picked up again by its worker
+            if key not in self._pending and key not in self._busy:
+                self._ready.append(key)
+                self._cond.notify()
+            pending = self._pending.setdefault(key, [])
+            if event["type"] != "MODIFIED":
+                pending.append(event)
+                self._not_before.pop(key, None)
+                return
+            # only the latest spec of a burst of MODIFIED events is pushed
+            if pending and pending[-1]["type"] == "MODIFIED":
+                pending[-1] = event
+                COALESCED_EVENTS.inc()
+            else:
+                pending.append(event)
+            self._not_before.setdefault(key, time.monotonic() + self.debounce)
+
+    def _next_key(self):
+        # first ready key whose debounce window is over
+        now = time.monotonic()
+        for key in self._ready:
+            if self._not_before.get(key, 0) <= now:
+                return key
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                key = self._next_key()
+                while key is None:
+                    now = time.monotonic()
+                    delays = [self._not_before[k] - now for k in self._ready if k in self._not_before]
+                    self._cond.wait(timeout=min(delays) if delays else None)
+                    key = self._next_key()
+                self._ready.remove(key)
+                self._not_before.pop(key, None)
+                events = self._pending.pop(key)
+                self._busy.add(key)
+            for event in events:
+                try:
+                    self.handler(event)
+                except Exception as e:
+                    print("Exception when reconciling %s: %s\n" % (key, e))
+            with self._cond:
+                self._busy.discard(key)
+                if key in self._pending:
+                    self._ready.append(key)
+                    self._cond.notify()
+
+
+def reconcile(event: dict):
     api_instance = client.CustomObjectsApi()
     group = "api.cosmotech.com"  # Update to the correct API group
     version = "v1"  # Update to the correct API version
     namespace = os.environ.get("NAMESPACE")  # Assuming custom resource is in default namespace
     plural = "solutions"
+    custom_resource = event["object"]
+    event_type = event["type"]
+    # Extract custom resource name
+    resource_name = custom_resource["metadata"]["name"]
+    myuid = custom_resource["metadata"]["uid"]
+    organization_name = (
+        custom_resource["spec"].get("selector", {}).get("organization", "")
+    )
+    # Extract key-value pairs from the custom resource spec
+    resource_data = custom_resource.get("spec", {})
+    # Handle events of type ADDED (resource created)
+    if event_type == "ADDED":
+        del resource_data["selector"]
+        org_object = get_org_id_by_name(organization_name=organization_name)
+        o = get_by_id(
+            org_id=org_object.get("spec").get("id"),
+            sol_id=resource_data.get("id", ""),
+        )
+        if not o:
+            if not resource_data.get("id"):
+                res_ = create(
+                    org_id=org_object.get("spec").get("id"), data=resource_data
+                )
+                custom_resource["spec"]["id"] = res_.get("id")
+                custom_resource["spec"]["uid"] = myuid
+                custom_resource["spec"]["name"] = res_.get("name")
+                custom_resource["spec"]["organizationId"] = org_object.get(
+                    "spec"
+                ).get("id")
+        try:
+            custom_resource["metadata"] = dict(
+                ownerReferences=[
+                    dict(
+                        name=org_object.get("metadata").get("name"),
+                        apiVersion="api.cosmotech.com/v1",
+                        kind="Organization",
+                        uid=org_object.get("metadata").get("uid"),
+                        blockOwnerDeletion=True,
+                    )
+                ],
+                **custom_resource["metadata"],
+            )
+            api_instance.patch_namespaced_custom_object(
+                group,
+                version,
+                namespace,
+                plural,
+                resource_name,
+                custom_resource,
+            )
+        except ApiException as e:
+            print("Exception when calling patch: %s\n" % e)
+    # Handle events of type DELETED (resource deleted)
+    elif event_type == "DELETED":
+        delete_obj(
+            org_id=resource_data.get("organizationId"),
+            sol_id=resource_data.get("id"),
+        )
+    elif event_type == "MODIFIED":
+        update(
+            org_id=resource_data.get("organizationId"),
+            sol_id=resource_data.get("id"),
+            data=resource_data,
+        )
+
+
+WATCH_RECONNECTS = Counter(
+    "triskell_watch_reconnects_total", "Watch streams reopened", ["plural"]
+)
+RELIST_SECONDS = Histogram(
+    "triskell_watch_relist_seconds", "Duration of full relists", ["plural"]
+)
+
+
+def relist(api_instance, group: str, version: str, namespace: str, plural: str, known: dict, work_queue) -> str:
+    """Lists the custom resources and queues only the ones that changed since they were last seen"""
+    start = time.monotonic()
+    response = api_instance.list_namespaced_custom_object(group, version, namespace, plural)
+    items = {item["metadata"]["name"]: item for item in response.get("items", [])}
+    previous = dict(known)
+    known.clear()
+    known.update({name: copy.deepcopy(item) for name, item in items.items()})
+    for name, item in items.items():
+        if name not in previous:
+            work_queue.add(name, {"type": "ADDED", "object": item})
+        elif previous[name]["metadata"]["resourceVersion"] != item["metadata"]["resourceVersion"]:
+            work_queue.add(name, {"type": "MODIFIED", "object": item})
+    for name in set(previous) - set(items):
+        work_queue.add(name, {"type": "DELETED", "object": previous[name]})
+    RELIST_SECONDS.labels(plural).observe(time.monotonic() - start)
+    return response["metadata"]["resourceVersion"]
 
+
+def main():
+    api_instance = client.CustomObjectsApi()
+    group = "api.cosmotech.com"  # Update to the correct API group
+    version = "v1"  # Update to the correct API version
+    namespace = os.environ.get("NAMESPACE")  # Assuming custom resource is in default namespace
+    plural = "solutions"
+    work_queue = WorkQueue(handler=reconcile)
     # Watch for events on custom resource
+    known = {}
     resource_version = ""
     while True:
-        stream = watch.Watch().stream(
-            api_instance.list_namespaced_custom_object,
-            group,
-            version,
-            namespace,
-            plural,
-            resource_version=resource_version,
-        )
-        for event in stream:
-            custom_resource = event["object"]
-            event_type = event["type"]
-            # Extract custom resource name
-            resource_name = custom_resource["metadata"]["name"]
-            myuid = custom_resource["metadata"]["uid"]
-            organization_name = (
-                custom_resource["spec"].get("selector", {}).get("organization", "")
-            )
-            # Extract key-value pairs from the custom resource spec
-            resource_data = custom_resource.get("spec", {})
-            # Handle events of type ADDED (resource created)
-            if event_type == "ADDED":
-                del resource_data["selector"]
-                org_object = get_org_id_by_name(organization_name=organization_name)
-                o = get_by_id(
-                    org_id=org_object.get("spec").get("id"),
-                    sol_id=resource_data.get("id", ""),
-                )
-                if not o:
-                    if not resource_data.get("id"):
-                        res_ = create(
-                            org_id=org_object.get("spec").get("id"), data=resource_data
-                        )
-                        custom_resource["spec"]["id"] = res_.get("id")
-                        custom_resource["spec"]["uid"] = myuid
-                        custom_resource["spec"]["name"] = res_.get("name")
-                        custom_resource["spec"]["organizationId"] = org_object.get(
-                            "spec"
-                        ).get("id")
-                try:
-                    custom_resource["metadata"] = dict(
-                        ownerReferences=[
-                            dict(
-                                name=org_object.get("metadata").get("name"),
-                                apiVersion="api.cosmotech.com/v1",
-                                kind="Organization",
-                                uid=org_object.get("metadata").get("uid"),
-                                blockOwnerDeletion=True,
-                            )
-                        ],
-                        **custom_resource["metadata"],
-                    )
-                    api_instance.patch_namespaced_custom_object(
-                        group,
-                        version,
-                        namespace,
-                        plural,
-                        resource_name,
-                        custom_resource,
-                    )
-                except ApiException as e:
-                    print("Exception when calling patch: %s\n" % e)
-            # Handle events of type DELETED (resource deleted)
-            elif event_type == "DELETED":
-                delete_obj(
-                    org_id=resource_data.get("organizationId"),
-                    sol_id=resource_data.get("id"),
+        try:
+            if not resource_version:
+                resource_version = relist(
+                    api_instance, group, version, namespace, plural, known, work_queue
                 )
-            elif event_type == "MODIFIED":
-                update(
-                    org_id=resource_data.get("organizationId"),
-                    sol_id=resource_data.get("id"),
-                    data=resource_data,
-                )
-            # Update resource_version to resume watching from the last event
-            resource_version = custom_resource["metadata"]["resourceVersion"]
+            stream = watch.Watch().stream(
+                api_instance.list_namespaced_custom_object,
+                group,
+                version,
+                namespace,
+                plural,
+                resource_version=resource_version,
+                allow_watch_bookmarks=True,
+                timeout_seconds=int(os.environ.get("WATCH_TIMEOUT_SECONDS", "300")),
+            )
+            for event in stream:
+                if not event:
+                    continue
+                custom_resource = event["object"]
+                # Update resource_version to resume watching from the last event
+                resource_version = custom_resource["metadata"]["resourceVersion"]
+                if event["type"] == "BOOKMARK":
+                    continue
+                resource_name = custom_resource["metadata"]["name"]
+                if event["type"] == "DELETED":
+                    known.pop(resource_name, None)
+                else:
+                    known[resource_name] = copy.deepcopy(custom_resource)
+                work_queue.add(resource_name, event)
+        except ApiException as e:
+            if e.status == 410:
+                # resourceVersion expired, relist and queue only what changed
+                resource_version = ""
+            else:
+                print("Exception when watching %s: %s\n" % (plural, e))
+                time.sleep(1)
+        except Exception as e:
+            # dropped connections and undecodable events, resume from the last resourceVersion seen
+            print("Exception when watching %s: %s\n" % (plural, e))
+            time.sleep(1)
+        WATCH_RECONNECTS.labels(plural).inc()
 
 
 def check_env():
@@ -228,4 +543,5 @@ def check_env():
 if __name__ == "__main__":
     check_env()
     config.load_incluster_config()  # Use in-cluster configuration
+    start_http_server(int(os.environ.get("METRICS_PORT", "8000")))
     main()